@@ -4,13 +4,17 @@ import irc.bot
 from jaraco.stream import buffer
 import logging
 import re
+import time
 
 log = logging.getLogger("cobe.bot")
 
 
 class Bot(irc.bot.SingleServerIRCBot):
+    # Seconds without channel messages before the bot counts as idle
+    IDLE_TIME = 30
+
     def __init__(self, brain, servers, nick, channel, log_channel, ignored_nicks,
-                 only_nicks):
+                 only_nicks, refill_interval=None):
         irc.bot.SingleServerIRCBot.__init__(self, servers, nick, nick)
 
         # Fall back to latin-1 if invalid utf-8 is provided.
@@ -23,6 +27,14 @@ class Bot(irc.bot.SingleServerIRCBot):
         self.ignored_nicks = ignored_nicks
         self.only_nicks = only_nicks
 
+        # Warm the brain's fragment cache while nobody is talking. This
+        # runs from the reactor, on the thread that owns the brain's
+        # database connection.
+        self.last_activity = time.time()
+        if refill_interval:
+            self.reactor.scheduler.execute_every(refill_interval,
+                                                 self.refill)
+
         if log_channel is not None:
             # set up a new logger
             handler = IrcLogHandler(self.connection, log_channel)
@@ -36,8 +48,13 @@ class Bot(irc.bot.SingleServerIRCBot):
         if self.log_channel:
             self.connection.join(self.log_channel)
 
+    def refill(self):
+        if time.time() - self.last_activity >= self.IDLE_TIME:
+            self.brain.refill_fragment_cache()
+
     def on_pubmsg(self, conn, event):
         user = irc.client.NickMask(event.source).nick
+        self.last_activity = time.time()
 
         if event.target == self.log_channel:
             # ignore input in the log channel
@@ -83,7 +100,8 @@ class Runner:
     def run(self, brain, args):
         log.info("connecting to %s:%s", args.server, args.port)
         bot = Bot(brain, [(args.server, args.port)], args.nick, args.channel,
-                  args.log_channel, args.ignored_nicks, args.only_nicks)
+                  args.log_channel, args.ignored_nicks, args.only_nicks,
+                  refill_interval=args.refill_interval)
         bot.start()
 
 
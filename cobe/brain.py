@@ -1,6 +1,8 @@
 # Copyright (C) 2013 Peter Teichman
 
+import array
 import collections
+import heapq
 import itertools
 import logging
 import math
@@ -9,9 +11,13 @@ import os
 import random
 import re
 import sqlite3
+import threading
 import time
+import urllib.parse
 
+from .cache import LRUCache
 from .instatrace import trace, trace_ms, trace_us
+from . import compiled
 from . import scoring
 from . import tokenizers
 
@@ -32,20 +38,99 @@ class Brain:
     # in the tokens table
     SPACE_TOKEN_ID = -1
 
-    def __init__(self, filename):
+    def __init__(self, filename, stem_cache_size=None,
+                 adjacency_cache_size=None, readonly=False, immutable=False,
+                 in_memory=False, save_interval=None, engine="random",
+                 fragment_cache_size=None, fragment_cache_ttl=None,
+                 pivot_policy="uniform", reply_cache_size=None,
+                 reply_cache_ttl=None):
         """Construct a brain for the specified filename. If that file
         doesn't exist, it will be initialized with the default brain
-        settings."""
+        settings. If it is a compiled brain (see Brain.compile), it is
+        opened read-only.
+
+        If stem_cache_size is set, up to that many stems are kept in
+        memory with their token ids, so stem conflation during reply
+        doesn't need to query the database for recently seen stems.
+
+        If adjacency_cache_size is set, the edges around recently
+        visited nodes are kept in memory, up to that many edges in
+        total, and serve later random walk steps and scoring.
+
+        If readonly is set, the brain is opened without write access
+        and never modified, so many processes can share it; learning
+        raises CobeError. Set immutable as well if the file can't
+        change while it's open (e.g. on read-only media), so SQLite
+        can skip locking entirely.
+
+        If in_memory is set, the whole brain is loaded into memory and
+        learning and replies run there. Changes are written back to
+        the file by save(), by close(), and every save_interval
+        seconds from a background thread if save_interval is set.
+        Each save copies the whole brain back to its file, so the
+        interval should be long relative to the brain's size.
+
+        engine selects how reply candidates are generated: "random"
+        for random walks out from each pivot, or "beam" for a beam
+        search that favors informative edges (see _search_beam).
+
+        pivot_policy weighs the input words replies are built around:
+        "uniform" picks each equally, "rarity" favors words found in
+        few contexts, and "fanout" favors words found in many.
+
+        If fragment_cache_size is set, the reply fragments found from
+        up to that many nodes (each holding at most
+        2 * REPLY_FRAGMENTS_PER_NODE fragments) are kept between
+        replies, least recently used first out, and for at most
+        fragment_cache_ttl seconds if that is set. Learning drops the
+        fragments of the nodes it touches. See refill_fragment_cache
+        to warm the cache while idle.
+
+        If reply_cache_size is set, the best few replies to up to that
+        many prompts are kept, keyed on the prompt's pivot tokens, and
+        a repeated prompt gets one of them at random instead of a new
+        search. Entries expire after reply_cache_ttl seconds if that
+        is set, and once REPLY_CACHE_LEARNED lines have been learned
+        since their search."""
+        if engine not in self.ENGINES:
+            raise CobeError("unknown reply engine: %s" % engine)
+
+        if pivot_policy not in self.PIVOT_POLICIES:
+            raise CobeError("unknown pivot policy: %s" % pivot_policy)
+
+        self.engine = engine
+        self.pivot_policy = pivot_policy
+
+        if readonly and not os.path.exists(filename):
+            raise CobeError("cannot open a missing brain read-only: %s"
+                            % filename)
+
         if not os.path.exists(filename):
             log.info("File does not exist. Assuming defaults.")
             Brain.init(filename)
 
+        self._filename = filename
+
         with trace_us("Brain.connect_us"):
-            self.graph = graph = Graph(sqlite3.connect(filename))
+            self._disk = None
+
+            if compiled.is_compiled(filename):
+                graph = compiled.CompiledGraph(filename)
+            elif in_memory:
+                graph, self._disk = self._load_in_memory(filename, readonly,
+                                                         immutable)
+            elif readonly:
+                graph = Graph(self._connect_readonly(filename, immutable),
+                              readonly=True)
+            else:
+                # check the version before Graph runs any migrations
+                conn = sqlite3.connect(filename)
+                self._check_version(Graph.read_version(conn))
+                graph = Graph(conn)
 
-        version = graph.get_info_text("version")
-        if version != "2":
-            raise CobeError("cannot read a version %s brain" % version)
+            self.graph = graph
+
+        self._check_version(graph.get_info_text("version"))
 
         self.order = int(graph.get_info_text("order"))
 
@@ -68,51 +153,338 @@ class Brain:
             except Exception as e:
                 log.error("Error creating stemmer: %s", str(e))
 
-        self._end_token_id = \
-            graph.get_token_by_text(self.END_TOKEN, create=True)
+        self._stem_cache_size = stem_cache_size
+        if stem_cache_size:
+            graph.enable_stem_cache(stem_cache_size)
+
+        self._adjacency_cache_size = adjacency_cache_size
+        if adjacency_cache_size:
+            graph.enable_adjacency_cache(adjacency_cache_size)
+
+        # New brains are initialized with the end token and end
+        # context node, so these only need to be created for brains
+        # that predate that.
+        self._end_token_id = graph.get_token_by_text(self.END_TOKEN)
+        if self._end_token_id is None and not graph.readonly:
+            self._end_token_id = \
+                graph.get_token_by_text(self.END_TOKEN, create=True)
+            graph.commit()
 
         self._end_context = [self._end_token_id] * self.order
-        self._end_context_id = graph.get_node_by_tokens(self._end_context)
+        self._end_context_id = graph.get_node_by_tokens(self._end_context,
+                                                        create=False)
+        if self._end_context_id is None and not graph.readonly:
+            self._end_context_id = \
+                graph.get_node_by_tokens(self._end_context)
+            graph.commit()
 
         self._learning = False
+        self._staged = False
+
+        # Serializes learning and replies with saves from the write
+        # back thread.
+        self._lock = threading.RLock()
+        self._saved_changes = graph.total_changes()
+
+        self._fragment_cache = None
+        if fragment_cache_size:
+            self._fragment_cache = LRUCache(fragment_cache_size)
+        self._fragment_cache_ttl = fragment_cache_ttl
+        self._pivot_counts = collections.Counter()
+
+        self._reply_cache = None
+        if reply_cache_size:
+            self._reply_cache = LRUCache(reply_cache_size)
+        self._reply_cache_ttl = reply_cache_ttl
+
+        # lines learned since the brain was opened, to expire replies
+        self._learned = 0
+
+        self._saver = None
+        if self._disk is not None and save_interval:
+            self._saver = _Saver(self, save_interval)
+            self._saver.start()
+
+    @staticmethod
+    def _check_version(version):
+        if version == "2":
+            raise CobeError("cannot read a version 2 brain, "
+                            "run \"cobe upgrade\" to convert it")
+        elif version != Graph.VERSION:
+            raise CobeError("cannot read a version %s brain" % version)
+
+    @staticmethod
+    def _connect_readonly(filename, immutable):
+        uri = "file:%s?mode=ro" % \
+            urllib.parse.quote(os.path.abspath(filename))
+        if immutable:
+            uri += "&immutable=1"
+
+        return sqlite3.connect(uri, uri=True)
+
+    @classmethod
+    def _load_in_memory(cls, filename, readonly, immutable):
+        # Copy the brain into an in-memory database. The connections
+        # are shared with the write back thread.
+        if readonly:
+            disk = cls._connect_readonly(filename, immutable)
+        else:
+            disk = sqlite3.connect(filename, check_same_thread=False)
+
+        with trace_ms("Brain.load_in_memory_ms"):
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+            disk.backup(conn)
+
+        if readonly:
+            disk.close()
+            return Graph(conn, readonly=True), None
+
+        return Graph(conn), disk
+
+    def save(self):
+        """Write an in-memory brain back to its file. This does nothing
+        for brains that aren't in memory or have no unsaved changes,
+        or while batch learning, when the brain is missing its reply
+        indexes and count triggers. Every save copies the whole brain
+        with the SQLite backup API."""
+        if self._disk is None:
+            return
+
+        with self._lock:
+            if self._learning:
+                log.debug("Not saving during batch learning")
+                return
+
+            changes = self.graph.total_changes()
+            if changes == self._saved_changes:
+                return
+
+            with trace_ms("Brain.save_ms"):
+                self.graph.commit()
+                self.graph.backup(self._disk)
+
+            self._saved_changes = changes
+
+    def close(self):
+        """Close the brain, saving it first if it is in memory."""
+        if self._saver is not None:
+            self._saver.stop()
+            self._saver = None
 
-    def start_batch_learning(self):
+        self.save()
+
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+        self.graph.close()
+
+    def _check_writable(self):
+        if self.graph.readonly:
+            raise CobeError("cannot modify a read-only brain")
+
+    # Batches smaller than this fraction of the brain's file size are
+    # learned through a staging table, keeping the reply indexes and
+    # node count triggers in place.
+    STAGED_BATCH_RATIO = 0.05
+
+    # Reply candidate generators selectable with Brain(engine=...)
+    ENGINES = ("random", "beam")
+
+    # Partial paths kept at each step of a beam search, and the most
+    # steps taken before giving up on reaching the end of a reply
+    BEAM_WIDTH = 8
+    BEAM_MAX_STEPS = 48
+
+    # Standard deviation of the noise added to each edge's information
+    # in a beam search
+    BEAM_NOISE = 1.0
+
+    # Pivot weightings selectable with Brain(pivot_policy=...)
+    PIVOT_POLICIES = ("uniform", "rarity", "fanout")
+
+    # Pivots _babble tries to find, and the random tokens it tries
+    BABBLE_PIVOTS = 5
+    BABBLE_ATTEMPTS = 50
+
+    # Reply fragments sampled per node while searching, and the most
+    # stored fragments each new one is joined with
+    REPLY_FRAGMENTS_PER_NODE = 64
+    REPLY_PAIRS_PER_FRAGMENT = 16
+
+    # Lines learn_many tokenizes, looks up and writes together
+    LEARN_BLOCK_SIZE = 256
+
+    # Distinct edges a block counts in memory before writing them out
+    LEARN_MAX_EDGES = 65536
+
+    # Pivot tokens remembered for refill_fragment_cache
+    PIVOT_HISTORY_SIZE = 1000
+
+    # Replies kept for each prompt in the reply cache, and the lines
+    # that can be learned before a cached prompt is searched again
+    REPLY_CACHE_POOL = 4
+    REPLY_CACHE_LEARNED = 100
+
+    # Cache sizes reply_many() enables for brains opened without them
+    REPLY_MANY_STEM_CACHE_SIZE = 10000
+    REPLY_MANY_ADJACENCY_CACHE_SIZE = 100000
+
+    def start_batch_learning(self, size_hint=None):
         """Begin a series of batch learn operations. Data will not be
         committed to the database until stop_batch_learning is
-        called. Learn text using the normal learn(text) method."""
-        self._learning = True
-
-        self.graph.cursor().execute("PRAGMA journal_mode=memory")
-        self.graph.drop_reply_indexes()
+        called. Learn text using the normal learn(text) method.
+
+        size_hint is the approximate number of bytes of text in the
+        batch. Batches that are small relative to the brain are
+        collected in a sorted staging table and merged into the edges
+        table on commit, and keep the end distances up to date. Other
+        batches (and batches without a hint) drop the reply index and
+        node count triggers while learning and rebuild them
+        afterwards; they leave the end distances stale until
+        update_end_distances is called."""
+        with self._lock:
+            self._check_writable()
+            self._learning = True
+
+            self._staged = size_hint is not None and \
+                size_hint < self.graph.size_bytes() * self.STAGED_BATCH_RATIO
+
+            if self._staged:
+                log.debug("Learning %d bytes through a staging table",
+                          size_hint)
+                self.graph.start_staging()
+                return
+
+            # other batches don't follow the end distances as they
+            # learn; update_end_distances has to be run again after
+            self.graph.mark_end_distances_stale()
+
+            self.graph.cursor().execute("PRAGMA journal_mode=memory")
+            self.graph.drop_reply_indexes()
+            self.graph.suspend_node_counts()
 
     def stop_batch_learning(self):
         """Finish a series of batch learn operations."""
-        self._learning = False
+        with self._lock:
+            self._learning = False
 
-        self.graph.commit()
-        self.graph.cursor().execute("PRAGMA journal_mode=truncate")
-        self.graph.ensure_indexes()
+            if self._staged:
+                self.graph.stop_staging()
+            else:
+                self.graph.commit()
+                self.graph.cursor().execute("PRAGMA journal_mode=truncate")
+                self.graph.ensure_indexes()
+                self.graph.resume_node_counts()
+
+                if self.graph.get_info_text("end_distances") == "stale":
+                    log.info("End distances are stale, run update_end_"
+                             "distances (cobe distances) to use them again")
+
+    def prune(self, min_count=2, batch_size=10000, vacuum=False):
+        """Remove edges learned fewer than min_count times, along with
+        any nodes, tokens and stems left unused. Work is committed
+        every batch_size nodes or tokens, so other readers of the
+        brain are only blocked briefly. If vacuum is set, the brain
+        file is compacted afterwards."""
+        with self._lock:
+            self._check_writable()
+            graph = self.graph
+
+            with trace_ms("Brain.prune_ms"):
+                self._forget_fragments()
+                self._forget_replies()
+                edges = graph.delete_rare_edges(min_count, batch_size)
+                nodes = graph.delete_orphan_nodes(batch_size,
+                                                  keep=[self._end_context_id])
+                tokens = graph.delete_unused_tokens(batch_size,
+                                                    keep=[self._end_token_id])
+                self._refresh_end_distances()
+
+            log.info("pruned %d edges, %d nodes, %d tokens",
+                     edges, nodes, tokens)
+
+            if vacuum:
+                with trace_ms("Brain.vacuum_ms"):
+                    graph.vacuum()
+
+            return edges, nodes, tokens
+
+    def merge(self, filename):
+        """Merge the brain in filename into this one. Both brains must
+        have the same order and tokenizer. Edge and node counts from
+        the other brain are added to this brain's counts."""
+        with self._lock:
+            self._check_writable()
+
+            with trace_ms("Brain.merge_ms"):
+                self.graph.merge(filename, stemmer=self.stemmer)
+                self._refresh_end_distances()
+
+            self._forget_fragments()
+            self._forget_replies()
+
+    def update_end_distances(self):
+        """Compute how many edges each node is from the end of a
+        reply, forward and backward. Once they're computed, replies
+        skip nodes that can't finish a reply (or can't finish it
+        within max_len), and learning keeps the distances up to date.
+        Batch learning, prune and merge recompute them. Returns the
+        number of nodes that can reach the end forward and backward."""
+        with self._lock:
+            self._check_writable()
+            forward, backward = \
+                self.graph.update_end_distances(self._end_context_id)
+
+            log.info("%d nodes reach the end forward, %d backward",
+                     forward, backward)
+            return forward, backward
+
+    def drop_end_distances(self):
+        """Remove the distances kept by update_end_distances."""
+        with self._lock:
+            self._check_writable()
+            self.graph.drop_end_distances()
+
+    def _refresh_end_distances(self):
+        # Recompute the end distances after changes that learning
+        # can't follow, if the brain keeps them.
+        if self.graph.get_info_text("end_distances") is not None:
+            self.graph.update_end_distances(self._end_context_id)
+
+    def compile(self, filename):
+        """Write this brain to filename in the compiled, read-only
+        format. A compiled brain is memory-mapped when opened, so it
+        starts quickly and its pages are shared between processes."""
+        with self._lock:
+            compiled.compile_graph(self.graph, filename)
 
     def del_stemmer(self):
-        self.stemmer = None
+        with self._lock:
+            self._check_writable()
+            self.stemmer = None
 
-        self.graph.delete_token_stems()
+            self.graph.delete_token_stems()
 
-        self.graph.set_info_text("stemmer", None)
-        self.graph.commit()
+            self.graph.set_info_text("stemmer", None)
+            self.graph.commit()
 
     def set_stemmer(self, language):
-        self.stemmer = tokenizers.CobeStemmer(language)
+        with self._lock:
+            self._check_writable()
+            self.stemmer = tokenizers.CobeStemmer(language)
 
-        self.graph.delete_token_stems()
-        self.graph.update_token_stems(self.stemmer)
+            self.graph.delete_token_stems()
+            self.graph.update_token_stems(self.stemmer)
 
-        self.graph.set_info_text("stemmer", language)
-        self.graph.commit()
+            self.graph.set_info_text("stemmer", language)
+            self.graph.commit()
 
     def learn(self, text):
         """Learn a string of text. If the input is not already
         Unicode, it will be decoded as utf-8."""
+        self._check_writable()
+
         if type(text) != str:
             # Assume that non-Unicode text is encoded as utf-8, which
             # should be somewhat safe in the modern world.
@@ -121,33 +493,121 @@ class Brain:
         tokens = self.tokenizer.split(text)
         trace("Brain.learn_input_token_count", len(tokens))
 
-        self._learn_tokens(tokens)
+        with self._lock:
+            self._learn_tokens(tokens)
+
+    def learn_many(self, items, commit_every=10000, progress=None,
+                   progress_every=1000, size_hint=None, dedup=None):
+        """Learn each of the iterable items: a string (decoded as
+        utf-8 if it isn't Unicode already), or a list of tokens as
+        returned by the brain's tokenizer. Items are learned in blocks
+        of LEARN_BLOCK_SIZE; each block is tokenized, its tokens are
+        looked up or created together, and its edges are counted and
+        written in key order.
+
+        Unless a batch learn is already in progress, the items are
+        learned in one (see start_batch_learning, which is passed
+        size_hint). Work is committed every commit_every items.
+
+        If dedup is set (see cobe.dedup.Deduplicator), items it
+        rejects as repeats are counted but not learned.
+
+        If progress is set, it is called with a LearnProgress every
+        progress_every items and once at the end. Returns the final
+        LearnProgress."""
+        self._check_writable()
+
+        with self._lock:
+            batch = not self._learning
+            if batch:
+                self.start_batch_learning(size_hint)
+
+        start = time.time()
+        lines = 0
+        nbytes = 0
+        duplicates = 0
+        next_commit = commit_every
+        next_progress = progress_every
+
+        def report():
+            elapsed = time.time() - start
+            rate = elapsed and 1.0 / elapsed
+            status = LearnProgress(lines, nbytes, elapsed, lines * rate,
+                                   nbytes * rate, duplicates)
+
+            trace("Brain.learn_many_lines_per_sec", status.lines_per_sec)
+            trace("Brain.learn_many_bytes_per_sec", status.bytes_per_sec)
+            trace("Brain.learn_many_duplicate_count", duplicates)
+            if progress is not None:
+                progress(status)
+
+            return status
+
+        try:
+            for block in _chunked(items, self.LEARN_BLOCK_SIZE):
+                token_lists = []
+                for item in block:
+                    if type(item) is bytes:
+                        nbytes += len(item)
+                        item = item.decode("utf-8", "ignore")
+                    elif type(item) is str:
+                        nbytes += len(item.encode("utf-8"))
+                    else:
+                        nbytes += sum(len(token.encode("utf-8"))
+                                      for token in item)
+
+                        text = "".join(item)
+                        if dedup is not None and not dedup.allow(text):
+                            duplicates += 1
+                        else:
+                            token_lists.append(item)
+                        continue
+
+                    if dedup is not None and not dedup.allow(item):
+                        duplicates += 1
+                        continue
+
+                    token_lists.append(self.tokenizer.split(item))
+
+                with self._lock:
+                    self._learn_block(token_lists)
+
+                lines += len(block)
+
+                if commit_every and lines >= next_commit:
+                    self.graph.commit()
+                    next_commit += commit_every
+
+                if lines >= next_progress:
+                    report()
+                    next_progress += progress_every
+        finally:
+            if batch:
+                self.stop_batch_learning()
+
+        return report()
 
     def _to_edges(self, tokens):
         """This is an iterator that returns the nodes of our graph:
 "This is a test" -> "None This" "This is" "is a" "a test" "test None"
 
 Each is annotated with a boolean that tracks whether whitespace was
-found between the two tokens."""
-        # prepend self.order Nones
-        chain = self._end_context + tokens + self._end_context
-
+found between the two tokens. tokens may be any iterable of token
+ids; only the last self.order of them are held at a time."""
+        context = collections.deque(maxlen=self.order)
         has_space = False
 
-        context = []
+        # surround the tokens with self.order end tokens
+        for token in itertools.chain(self._end_context, tokens,
+                                     self._end_context):
+            if token == self.SPACE_TOKEN_ID:
+                has_space = True
+                continue
 
-        for i in range(len(chain)):
-            context.append(chain[i])
+            context.append(token)
 
             if len(context) == self.order:
-                if chain[i] == self.SPACE_TOKEN_ID:
-                    context.pop()
-                    has_space = True
-                    continue
-
                 yield tuple(context), has_space
-
-                context.pop(0)
                 has_space = False
 
     def _to_graph(self, contexts):
@@ -164,38 +624,171 @@ with its two nodes"""
             prev = context
 
     def _learn_tokens(self, tokens):
-        token_count = len([token for token in tokens if token != " "])
-        if token_count < 3:
+        self._learn_block([tokens])
+
+        if not self._learning:
+            self.graph.commit()
+
+    def _learn_block(self, token_lists):
+        # Learn a block of tokenized lines. Their tokens are looked up
+        # or created together, and their edges are counted and then
+        # written in key order.
+        lines = [tokens for tokens in token_lists
+                 if sum(token != " " for token in tokens) >= 3]
+        if not lines:
             return
 
+        self._learned += len(lines)
+
+        graph = self.graph
+
         # create each of the non-whitespace tokens
-        token_ids = []
-        for text in tokens:
-            if text == " ":
-                token_ids.append(self.SPACE_TOKEN_ID)
-                continue
+        token_ids = graph.get_token_ids(
+            (text for tokens in lines for text in tokens if text != " "),
+            stemmer=self.stemmer)
+        token_ids[" "] = self.SPACE_TOKEN_ID
 
-            token_id = self.graph.get_token_by_text(text, create=True,
-                                                    stemmer=self.stemmer)
-            token_ids.append(token_id)
+        # node ids by context, for the contexts repeated in the block
+        nodes = {}
 
-        edges = list(self._to_edges(token_ids))
+        def node_id(context):
+            node = nodes.get(context)
+            if node is None:
+                node = nodes[context] = graph.get_node_by_tokens(context)
+            return node
 
-        prev_id = None
-        for prev, has_space, next in self._to_graph(edges):
-            if prev_id is None:
-                prev_id = self.graph.get_node_by_tokens(prev)
-            next_id = self.graph.get_node_by_tokens(next)
+        edges = collections.Counter()
 
-            self.graph.add_edge(prev_id, next_id, has_space)
-            prev_id = next_id
+        # the node paths learned, if the end distances need them
+        paths = None
+        if graph.has_end_distances():
+            paths = []
 
-        if not self._learning:
-            self.graph.commit()
+        def flush():
+            graph.add_edges(edges)
+            edges.clear()
+
+            self._forget_fragments(nodes.values())
+            nodes.clear()
+
+        for tokens in lines:
+            contexts = self._to_edges(token_ids[text] for text in tokens)
+
+            path = None
+            if paths is not None:
+                path = array.array("q")
+                paths.append(path)
+
+            prev_id = None
+            for prev, has_space, next in self._to_graph(contexts):
+                if prev_id is None:
+                    prev_id = node_id(prev)
+                    if path is not None:
+                        path.append(prev_id)
+                next_id = node_id(next)
+
+                edges[prev_id, next_id, has_space] += 1
+                prev_id = next_id
+                if path is not None:
+                    path.append(next_id)
+
+                # long documents are written as they go, so memory
+                # stays bounded by the number of distinct edges held
+                if len(edges) >= self.LEARN_MAX_EDGES:
+                    flush()
+
+        flush()
+
+        for path in paths or ():
+            graph.relax_end_distances(path)
 
     def reply(self, text, loop_ms=500, max_len=None):
         """Reply to a string of text. If the input is not already
         Unicode, it will be decoded as utf-8."""
+        with self._lock:
+            return self._reply(text, loop_ms, max_len)
+
+    def reply_many(self, texts, loop_ms=500, max_len=None,
+                   max_candidates=None, processes=None):
+        """Reply to each string in the iterable texts, yielding the
+        replies in order. This is meant for evaluating a brain against
+        many prompts: the stem and adjacency caches are enabled and
+        shared across prompts, and max_candidates caps the number of
+        candidates scored per prompt.
+
+        If processes is greater than one, the prompts are spread over
+        that many worker processes, each with its own read-only
+        connection to the brain file.
+
+        Caches the brain was opened without are only kept while the
+        generator runs, and are turned off again once it finishes or
+        is closed."""
+        if processes is not None and processes > 1:
+            yield from self._reply_many_parallel(texts, loop_ms, max_len,
+                                                 max_candidates, processes)
+            return
+
+        with self._lock:
+            stem_cache = not self._stem_cache_size
+            if stem_cache:
+                self.graph.enable_stem_cache(self.REPLY_MANY_STEM_CACHE_SIZE)
+
+            adjacency_cache = not self._adjacency_cache_size
+            if adjacency_cache:
+                self.graph.enable_adjacency_cache(
+                    self.REPLY_MANY_ADJACENCY_CACHE_SIZE)
+
+        try:
+            for text in texts:
+                with self._lock:
+                    reply = self._reply(text, loop_ms, max_len,
+                                        max_candidates)
+                yield reply
+        finally:
+            with self._lock:
+                if stem_cache:
+                    self.graph.enable_stem_cache(None)
+
+                if adjacency_cache:
+                    self.graph.enable_adjacency_cache(None)
+
+    def _reply_many_parallel(self, texts, loop_ms, max_len, max_candidates,
+                             processes):
+        import multiprocessing
+
+        # Workers open the file, so unsaved in-memory changes need to
+        # be written back first.
+        if self._disk is not None and not self.graph.readonly:
+            self.save()
+
+        settings = (self._filename, loop_ms, max_len, max_candidates,
+                    self.REPLY_MANY_STEM_CACHE_SIZE,
+                    self.REPLY_MANY_ADJACENCY_CACHE_SIZE, self.engine,
+                    self.pivot_policy)
+
+        with multiprocessing.Pool(processes, _reply_worker_init,
+                                  settings) as pool:
+            yield from pool.imap(_reply_worker, texts, chunksize=16)
+
+    def reply_topk(self, text, k, loop_ms=500, max_len=None):
+        """Reply to a string of text, returning up to k of the best
+        distinct replies found in a single search, best first. Each
+        is a ScoredReply of (text, score, pivot_node)."""
+        with self._lock:
+            tokens, input_ids, pivot_set = self._prepare_input(text)
+            replies, count, unique = self._search(tokens, input_ids,
+                                                  pivot_set, loop_ms,
+                                                  max_len, k)
+
+            if replies:
+                self.scorer.end(replies[0][1])
+
+            # only the winners have their text looked up
+            with trace_us("Brain.reply_words_lookup_us"):
+                return [ScoredReply(reply.to_text(), score, reply.pivot_node)
+                        for score, reply in replies]
+
+    def _prepare_input(self, text, babble=True):
         if type(text) != str:
             # Assume that non-Unicode text is encoded as utf-8, which
             # should be somewhat safe in the modern world.
@@ -213,13 +806,20 @@ with its two nodes"""
 
         # If we didn't recognize any word tokens in the input, pick
         # something random from the database and babble.
-        if len(pivot_set) == 0:
+        if len(pivot_set) == 0 and babble:
             pivot_set = self._babble()
 
-        score_cache = {}
+        return tokens, input_ids, pivot_set
 
-        best_score = -1.0
-        best_reply = None
+    def _search(self, tokens, input_ids, pivot_set, loop_ms, max_len, k=1,
+                max_candidates=None):
+        # Generate and score replies for about loop_ms milliseconds,
+        # or until max_candidates have been seen, keeping the k best
+        # distinct ones in a min-heap. Returns the (score, reply)
+        # pairs best first, with the number of candidates seen and the
+        # number of distinct candidates.
+        score_cache = {}
+        best = []
 
         # Loop for approximately loop_ms milliseconds. This can either
         # take more (if the first reply takes a long time to generate)
@@ -231,43 +831,46 @@ with its two nodes"""
 
         all_replies = []
 
-        _start = time.time()
-        for edges, pivot_node in self._generate_replies(pivot_set):
+        # Partial scores of the fragments replies are made from, so
+        # each reply is scored from the partial scores of its two
+        # fragments rather than edge by edge.
+        partials = {}
+
+        for prev, next, pivot_node in self._generate_replies(pivot_set, end,
+                                                             max_len):
+            edges = prev + next
             reply = Reply(self.graph, tokens, input_ids, pivot_node, edges)
 
-            if max_len and self._too_long(max_len, reply):
-                continue
+            count += 1
 
-            key = reply.edge_ids
+            # Replies are looked up by the packed bytes of their edge
+            # ids, which are much smaller than a tuple of ints.
+            key = edges.tobytes()
             if key not in score_cache:
                 with trace_us("Brain.evaluate_reply_us"):
-                    score = self.scorer.score(reply)
+                    score = self._score(reply, prev, next, partials)
                     score_cache[key] = score
+
+                # Ties keep the reply found first, so the heap orders
+                # them by the negated candidate count.
+                entry = (score, -count, reply)
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
             else:
                 # skip scoring, we've already seen this reply
                 score = -1
 
-            if score > best_score:
-                best_reply = reply
-                best_score = score
-
             # dump all replies to the console if debugging is enabled
             if log.isEnabledFor(logging.DEBUG):
                 all_replies.append((score, reply))
 
-            count += 1
             if time.time() > end:
                 break
 
-        if best_reply is None:
-            # we couldn't find any pivot words in _babble(), so we're
-            # working with an essentially empty brain. Use the classic
-            # MegaHAL reply:
-            return "I don't know enough to answer you yet!"
-
-        _time = time.time() - _start
-
-        self.scorer.end(best_reply)
+            if max_candidates and count >= max_candidates:
+                break
 
         if log.isEnabledFor(logging.DEBUG):
             replies = [(score, reply.to_text())
@@ -277,6 +880,72 @@ with its two nodes"""
             for score, text in replies:
                 log.debug("%f %s", score, text)
 
+        best.sort(reverse=True)
+        return [(score, reply) for score, _, reply in best], count, \
+            len(score_cache)
+
+    def _score(self, reply, prev, next, partials):
+        # Score a reply made of the fragments prev and next
+        p = self._fragment_partial(prev, partials)
+        n = self._fragment_partial(next, partials)
+        if p is None or n is None:
+            return self.scorer.score(reply)
+
+        return self.scorer.combine(self.graph, p, n)
+
+    def _fragment_partial(self, fragment, partials):
+        key = fragment.tobytes()
+        if key not in partials:
+            partials[key] = self.scorer.fragment(self.graph, fragment)
+
+        return partials[key]
+
+    def _reply(self, text, loop_ms, max_len, max_candidates=None):
+        _start = time.time()
+
+        tokens, input_ids, pivot_set = self._prepare_input(text,
+                                                           babble=False)
+
+        # Babbled replies are random anyway, so only prompts with
+        # pivots are cached. The key holds everything that shapes the
+        # search, so a reply is only reused for the same kind of call.
+        cache_key = None
+        if self._reply_cache is not None and pivot_set:
+            cache_key = (frozenset(pivot_set), max_len, loop_ms,
+                         max_candidates, self.engine, self.pivot_policy)
+
+            cached = self._cached_reply(cache_key)
+            if cached is not None:
+                text, reply = cached
+
+                self.scorer.end(reply)
+
+                trace("Brain.cached_reply_us", time.time() - _start)
+                return text
+
+        if not pivot_set:
+            pivot_set = self._babble()
+
+        k = 1
+        if cache_key is not None:
+            k = self.REPLY_CACHE_POOL
+
+        replies, count, unique = self._search(tokens, input_ids, pivot_set,
+                                              loop_ms, max_len, k,
+                                              max_candidates)
+
+        if not replies:
+            # we couldn't find any pivot words in _babble(), so we're
+            # working with an essentially empty brain. Use the classic
+            # MegaHAL reply:
+            return "I don't know enough to answer you yet!"
+
+        best_score, best_reply = replies[0]
+
+        _time = time.time() - _start
+
+        self.scorer.end(best_reply)
+
         trace("Brain.reply_input_token_count", len(tokens))
         trace("Brain.known_word_token_count", len(pivot_set))
 
@@ -286,7 +955,10 @@ with its two nodes"""
         trace("Brain.best_reply_length", len(best_reply.edge_ids))
 
         log.debug("made %d replies (%d unique) in %f seconds"
-                  % (count, len(score_cache), _time))
+                  % (count, unique, _time))
+
+        if type(text) != str:
+            text = text.decode("utf-8", "ignore")
 
         if len(text) > 60:
             msg = text[0:60] + "..."
@@ -299,13 +971,33 @@ with its two nodes"""
         with trace_us("Brain.reply_words_lookup_us"):
             text = best_reply.to_text()
 
+        if cache_key is not None:
+            pool = [(text, best_reply)] + [(reply.to_text(), reply) for
+                                           score, reply in replies[1:]]
+            self._reply_cache.put(cache_key, (time.time(), self._learned,
+                                              pool))
+
         return text
 
-    def _too_long(self, max_len, reply):
-        text = reply.to_text()
-        if len(text) > max_len:
-            log.debug("over max_len [%d]: %s", len(text), text)
-            return True
+    def _cached_reply(self, key):
+        # Return one of the cached (text, reply) pairs for key at
+        # random, or None
+        entry = self._reply_cache.get(key)
+        if entry is None:
+            return None
+
+        stamp, learned, pool = entry
+        if self._reply_cache_ttl is not None and \
+                time.time() - stamp > self._reply_cache_ttl or \
+                self._learned - learned >= self.REPLY_CACHE_LEARNED:
+            self._reply_cache.pop(key)
+            return None
+
+        return random.choice(pool)
+
+    def _forget_replies(self):
+        if self._reply_cache is not None:
+            self._reply_cache.clear()
 
     def _conflate_stems(self, pivot_set, tokens):
         for token in tokens:
@@ -319,15 +1011,25 @@ with its two nodes"""
             pivot_set.difference_update(stem_ids)
 
     def _babble(self):
-        token_ids = []
-        for i in range(5):
-            # Generate a few random tokens that can be used as pivots
-            token_id = self.graph.get_random_token()
+        # Find a few random word tokens that can be used as pivots.
+        # Token ids can have gaps (after prune), and not every token
+        # is a word that starts a context, so a few more are tried.
+        graph = self.graph
 
-            if token_id is not None:
-                token_ids.append(token_id)
+        token_ids = set()
+        for i in range(self.BABBLE_ATTEMPTS):
+            token_id = graph.get_random_token()
+            if token_id is None:
+                break
 
-        return set(token_ids)
+            if token_id not in token_ids and \
+                    graph.get_word_tokens([token_id]) and \
+                    graph.get_token_node_count(token_id):
+                token_ids.add(token_id)
+                if len(token_ids) == self.BABBLE_PIVOTS:
+                    break
+
+        return token_ids
 
     def _filter_pivots(self, pivots):
         # remove pivots that might not give good results
@@ -339,59 +1041,303 @@ with its two nodes"""
 
         return set(filtered)
 
-    def _pick_pivot(self, pivot_ids):
-        pivot = random.choice(tuple(pivot_ids))
+    def _resolve_pivots(self, pivot_ids):
+        # Look up how many nodes start with each pivot token, dropping
+        # the tokens that start none. Returns the live (token id, node
+        # count) pairs with cumulative weights to pick them by.
+        graph = self.graph
 
-        if type(pivot) is tuple:
-            # the input word was stemmed to several things
-            pivot = random.choice(pivot)
+        pivots = []
+        weights = []
+        for pivot in pivot_ids:
+            # the input word may have been stemmed to several things,
+            # which share its weight
+            group = pivot if type(pivot) is tuple else (pivot,)
 
-        return pivot
+            for token_id in group:
+                count = graph.get_token_node_count(token_id)
+                if not count:
+                    continue
 
-    def _generate_replies(self, pivot_ids):
+                pivots.append((token_id, count))
+                weights.append(self._pivot_weight(count) / len(group))
+
+        return pivots, list(itertools.accumulate(weights))
+
+    def _pivot_weight(self, count):
+        if self.pivot_policy == "rarity":
+            return 1.0 / count
+        elif self.pivot_policy == "fanout":
+            return float(count)
+
+        return 1.0
+
+    def _pick_node(self, pivots, cum_weights):
+        # Pick a pivot token, and then a random node starting with it
+        token_id, count = random.choices(pivots, cum_weights=cum_weights)[0]
+        return self.graph.get_token_node(token_id, random.randrange(count))
+
+    def _generate_replies(self, pivot_ids, deadline, max_len=None):
+        # Fragments that are already stored don't produce candidates,
+        # so this checks the deadline itself rather than relying on
+        # the caller's loop to see a candidate.
         if not pivot_ids:
             return
 
         end = self._end_context_id
-        graph = self.graph
-        search = graph.search_random_walk
+        pairs = self.REPLY_PAIRS_PER_FRAGMENT
 
-        # Cache all the trailing and beginning sentences we find from
-        # each random node we search. Since the node is a full n-tuple
-        # context, we can combine any pair of next_cache[node] and
-        # prev_cache[node] and get a new reply.
-        next_cache = collections.defaultdict(set)
-        prev_cache = collections.defaultdict(set)
+        search = self._fragment_search()
 
-        while pivot_ids:
+        if self._fragment_cache is not None:
+            self._count_pivots(pivot_ids)
+
+        pivots, cum_weights = self._resolve_pivots(pivot_ids)
+        if not pivots:
+            return
+
+        if not max_len:
+            max_len = None
+
+        def fits(a, a_len, b, b_len):
+            if max_len is None:
+                return True
+
+            return self._fragment_length(a, a_len) + \
+                self._fragment_length(b, b_len) <= max_len
+
+        def length(fragment):
+            if max_len is not None:
+                return self._fragment_length(fragment)
+
+        # Keep a sample of the trailing and beginning sentences we
+        # find from each random node we search. Since the node is a
+        # full n-tuple context, we can combine any pair of its next
+        # and prev fragments and get a new reply. With max_len set,
+        # each fragment's text length is kept with it, so pairs that
+        # would make too long a reply are skipped without looking up
+        # their text.
+        stores = {}
+
+        while time.time() <= deadline:
             # generate a reply containing one of token_ids
-            pivot_id = self._pick_pivot(pivot_ids)
-            node = graph.get_random_node_with_token(pivot_id)
+            node = self._pick_node(pivots, cum_weights)
+
+            if node not in stores:
+                next_store, prev_store = stores[node] = \
+                    self._fragment_stores(node)
 
-            parts = itertools.zip_longest(search(node, end, 1),
-                                           search(node, end, 0),
+                # fragments kept from earlier replies pair up at once
+                for p, p_len in prev_store.sample(pairs):
+                    for n, n_len in next_store.sample(pairs):
+                        if fits(p, p_len, n, n_len):
+                            yield p, n, node
+
+            next_store, prev_store = stores[node]
+
+            parts = itertools.zip_longest(search(node, end, 1, max_len),
+                                           search(node, end, 0, max_len),
                                            fillvalue=None)
 
             for next, prev in parts:
                 if next:
-                    next_cache[node].add(next)
-                    for p in prev_cache[node]:
-                        yield p + next, node
+                    next = array.array("q", next)
+                    next_len = length(next)
+                    if next_store.add(next, next_len):
+                        for p, p_len in prev_store.sample(pairs):
+                            if fits(p, p_len, next, next_len):
+                                yield p, next, node
 
                 if prev:
-                    prev = tuple(reversed(prev))
-                    prev_cache[node].add(prev)
-                    for n in next_cache[node]:
-                        yield prev + n, node
+                    prev = array.array("q", reversed(prev))
+                    prev_len = length(prev)
+                    if prev_store.add(prev, prev_len):
+                        for n, n_len in next_store.sample(pairs):
+                            if fits(prev, prev_len, n, n_len):
+                                yield prev, n, node
+
+    def _fragment_length(self, edge_ids, known=None):
+        # The length of the text of edge_ids, unless it's known. It's
+        # unknown for fragments cached while replying without max_len.
+        if known is not None:
+            return known
+
+        get_edge_length = self.graph.get_edge_length
+        return sum(get_edge_length(edge_id) for edge_id in edge_ids)
+
+    def _fragment_search(self):
+        if self.engine == "beam":
+            return self._search_beam
+
+        return self.graph.search_random_walk
+
+    def _fragment_stores(self, node):
+        # Return the (next, prev) fragment stores for node, from the
+        # fragment cache if it's enabled.
+        size = self.REPLY_FRAGMENTS_PER_NODE
+
+        cache = self._fragment_cache
+        if cache is None:
+            return _FragmentStore(size), _FragmentStore(size)
+
+        now = time.time()
+
+        entry = cache.get(node)
+        if entry is not None and self._fragment_cache_ttl is not None \
+                and now - entry[0] > self._fragment_cache_ttl:
+            entry = None
+
+        if entry is None:
+            entry = (now, _FragmentStore(size), _FragmentStore(size))
+            cache.put(node, entry)
+
+        return entry[1], entry[2]
+
+    def _count_pivots(self, pivot_ids):
+        counts = self._pivot_counts
+        for pivot in pivot_ids:
+            if type(pivot) is tuple:
+                counts.update(pivot)
+            else:
+                counts[pivot] += 1
+
+        # keep only the most popular pivots once the history is full
+        if len(counts) > self.PIVOT_HISTORY_SIZE:
+            self._pivot_counts = collections.Counter(
+                dict(counts.most_common(self.PIVOT_HISTORY_SIZE // 2)))
+
+    def _forget_fragments(self, node_ids=None):
+        # Drop the cached fragments of node_ids, or all of them
+        if self._fragment_cache is None:
+            return
+
+        if node_ids is None:
+            self._fragment_cache.clear()
+            return
+
+        for node_id in node_ids:
+            self._fragment_cache.pop(node_id)
+
+    def refill_fragment_cache(self, budget_ms=100, max_pivots=8):
+        """Search from the max_pivots most popular recent pivot tokens
+        for about budget_ms milliseconds, adding what's found to the
+        fragment cache so later replies on those topics start warm.
+        Meant to be called while a bot is idle. Returns the number of
+        fragments added."""
+        if self._fragment_cache is None:
+            return 0
+
+        with self._lock:
+            pivots, cum_weights = self._resolve_pivots(
+                [pivot for pivot, count
+                 in self._pivot_counts.most_common(max_pivots)])
+            if not pivots:
+                return 0
+
+            end = self._end_context_id
+            search = self._fragment_search()
+
+            added = 0
+            deadline = time.time() + budget_ms * 0.001
+
+            with trace_us("Brain.refill_fragment_cache_us"):
+                while time.time() < deadline:
+                    node = self._pick_node(pivots, cum_weights)
+                    next_store, prev_store = self._fragment_stores(node)
+
+                    for path in itertools.islice(search(node, end, 1), 1):
+                        added += next_store.add(array.array("q", path))
+
+                    for path in itertools.islice(search(node, end, 0), 1):
+                        added += prev_store.add(
+                            array.array("q", reversed(path)))
+
+            trace("Brain.refill_fragment_count", added)
+            return added
+
+    def _search_beam(self, start_id, end_id, direction, max_len=None):
+        """Search from start_id for paths to end_id, yielding each path
+        as it is completed. Every step extends the partial paths kept
+        so far by one edge and keeps the BEAM_WIDTH with the most
+        information per square root of their text length, so the
+        search favors the rare edges the scorer rewards over the
+        common ones a random walk tends to take, without favoring long
+        words for their length alone. Nodes with a single edge are
+        passed through without competing, so paths that are about to
+        end aren't dropped for it. Gaussian noise (BEAM_NOISE) on
+        each edge's information varies the paths found when a node is
+        searched again. If max_len is set, paths are dropped once
+        their text is longer than that."""
+        graph = self.graph
+        width = self.BEAM_WIDTH
+        noise = self.BEAM_NOISE
+        max_steps = self.BEAM_MAX_STEPS
+        distances = graph.has_end_distances()
+
+        def adjacent(node, length):
+            rows = graph.get_adjacent_info(node, direction)
+            if distances:
+                rows = graph.reachable_edges(rows, direction, max_len, length)
+            return rows
+
+        beam = [(0.0, (), 0, start_id)]
+        while beam:
+            expanded = []
+
+            for info, path, length, node in beam:
+                rows = adjacent(node, length)
+
+                # follow edges that have no alternative straight away:
+                # they add little or no information, and would drop a
+                # path that is about to end out of the beam
+                while len(rows) == 1 and rows[0][1] != end_id and \
+                        len(path) < max_steps:
+                    edge_id, node, _, _, logprob, edge_length = rows[0]
+
+                    length += edge_length
+                    if max_len is not None and length > max_len:
+                        rows = []
+                        break
+
+                    info -= logprob
+                    path += (edge_id,)
+                    rows = adjacent(node, length)
+
+                if len(path) >= max_steps:
+                    continue
+
+                for edge_id, other, _, _, logprob, edge_length in rows:
+                    edge_length += length
+                    if max_len is not None and edge_length > max_len:
+                        continue
+
+                    edge_info = info - logprob
+                    if noise:
+                        edge_info += random.gauss(0.0, noise)
+                    edge_path = path + (edge_id,)
+
+                    if other == end_id:
+                        yield edge_path
+                    else:
+                        rank = edge_info / math.sqrt(max(1, edge_length))
+                        expanded.append((rank, edge_info, edge_path,
+                                         edge_length, other))
+
+            beam = [(info, path, length, node)
+                    for _, info, path, length, node
+                    in heapq.nlargest(width, expanded)]
 
     @staticmethod
-    def init(filename, order=3, tokenizer=None):
+    def init(filename, order=3, tokenizer=None, packed_keys=False):
         """Initialize a brain. This brain's file must not already exist.
 
 Keyword arguments:
 order -- Order of the forward/reverse Markov chains (integer)
 tokenizer -- One of Cobe, MegaHAL (default Cobe). See documentation
-             for cobe.tokenizers for details. (string)"""
+             for cobe.tokenizers for details. (string)
+packed_keys -- Look up nodes by a single packed key column rather than
+               by all their token ids, which shrinks the node index
+               for higher order brains. (boolean)"""
         log.info("Initializing a cobe brain: %s" % filename)
 
         if tokenizer is None:
@@ -404,7 +1350,147 @@ tokenizer -- One of Cobe, MegaHAL (default Cobe). See documentation
         graph = Graph(sqlite3.connect(filename))
 
         with trace_us("Brain.init_time_us"):
-            graph.init(order, tokenizer)
+            graph.init(order, tokenizer, end_token=Brain.END_TOKEN,
+                       packed_keys=packed_keys)
+
+    @staticmethod
+    def upgrade(filename, packed_keys=False):
+        """Upgrade an older brain to the current schema in place. If
+        packed_keys is set, also switch it to packed node keys."""
+        log.info("Upgrading a cobe brain: %s" % filename)
+
+        graph = Graph(sqlite3.connect(filename), run_migrations=False)
+        graph.upgrade()
+
+        if packed_keys:
+            graph.pack_node_keys()
+
+        graph.close()
+
+
+class _Saver(threading.Thread):
+    """Periodically saves an in-memory brain back to its file."""
+    def __init__(self, brain, interval):
+        threading.Thread.__init__(self, name="cobe-saver", daemon=True)
+
+        self.brain = brain
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.brain.save()
+            except Exception:
+                log.exception("Error saving brain")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _chunked(items, size):
+    # Split the iterable items into lists of up to size items
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _process_alive(pid):
+    if pid == os.getpid():
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+# Per-process state for Brain.reply_many worker pools
+_worker_brain = None
+_worker_args = None
+
+
+def _reply_worker_init(filename, loop_ms, max_len, max_candidates,
+                       stem_cache_size, adjacency_cache_size, engine,
+                       pivot_policy):
+    global _worker_brain, _worker_args
+
+    _worker_brain = Brain(filename, stem_cache_size=stem_cache_size,
+                          adjacency_cache_size=adjacency_cache_size,
+                          readonly=True, engine=engine,
+                          pivot_policy=pivot_policy)
+    _worker_args = (loop_ms, max_len, max_candidates)
+
+
+def _reply_worker(text):
+    return _worker_brain._reply(text, *_worker_args)
+
+
+class _FragmentStore:
+    """A bounded reservoir sample of the distinct reply fragments
+    (array('q') edge id sequences) found from one node, with the
+    length of each fragment's text."""
+    __slots__ = ("fragments", "lengths", "keys", "seen", "maxsize")
+
+    def __init__(self, maxsize):
+        self.fragments = []
+        self.lengths = []
+        self.keys = set()
+        self.seen = 0
+        self.maxsize = maxsize
+
+    def add(self, fragment, length=0):
+        """Offer a fragment to the sample. Returns False if it was
+        already there, and True otherwise (even if it lost its place
+        in the reservoir)."""
+        key = fragment.tobytes()
+        if key in self.keys:
+            return False
+
+        self.seen += 1
+
+        if len(self.fragments) < self.maxsize:
+            self.fragments.append(fragment)
+            self.lengths.append(length)
+            self.keys.add(key)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.maxsize:
+                self.keys.discard(self.fragments[i].tobytes())
+                self.fragments[i] = fragment
+                self.lengths[i] = length
+                self.keys.add(key)
+
+        return True
+
+    def sample(self, count):
+        """Return up to count (fragment, length) pairs."""
+        indexes = range(len(self.fragments))
+        if len(indexes) > count:
+            indexes = random.sample(indexes, count)
+
+        return [(self.fragments[i], self.lengths[i]) for i in indexes]
+
+
+# The progress of Brain.learn_many: items read, bytes of their text,
+# seconds elapsed, the rates of the first two, and the items skipped
+# as duplicates
+LearnProgress = collections.namedtuple("LearnProgress",
+                                       ["lines", "bytes", "elapsed",
+                                        "lines_per_sec", "bytes_per_sec",
+                                        "duplicates"])
+
+# A reply returned by Brain.reply_topk
+ScoredReply = collections.namedtuple("ScoredReply",
+                                     ["text", "score", "pivot_node"])
 
 
 class Reply:
@@ -431,24 +1517,116 @@ class Reply:
         return self.text
 
 
+def pack_node_key(*token_ids):
+    """Pack a node's token ids into a variable length key. Each id is
+    an order-preserving varint (as in SQLite 4), so keys sort like
+    their token id tuples and the keys of all nodes starting with a
+    token lie between the keys of that token and the next."""
+    key = bytearray()
+    for v in token_ids:
+        if v <= 240:
+            key.append(v)
+        elif v <= 2287:
+            v -= 240
+            key += bytes((241 + (v >> 8), v & 0xff))
+        elif v <= 67823:
+            v -= 2288
+            key += bytes((249, v >> 8, v & 0xff))
+        else:
+            n = max(3, (v.bit_length() + 7) // 8)
+            key.append(247 + n)
+            key += v.to_bytes(n, "big")
+
+    return bytes(key)
+
+
+def unpack_node_key(key):
+    """Return the tuple of token ids packed into key."""
+    token_ids = []
+
+    i = 0
+    while i < len(key):
+        a = key[i]
+        if a <= 240:
+            token_ids.append(a)
+            i += 1
+        elif a <= 248:
+            token_ids.append(240 + ((a - 241) << 8) + key[i + 1])
+            i += 2
+        elif a == 249:
+            token_ids.append(2288 + (key[i + 1] << 8) + key[i + 2])
+            i += 3
+        else:
+            n = a - 247
+            token_ids.append(int.from_bytes(key[i + 1:i + 1 + n], "big"))
+            i += 1 + n
+
+    return tuple(token_ids)
+
+
+def _node_key_token(key, i):
+    return unpack_node_key(key)[i]
+
+
 class Graph:
     """A special-purpose graph class, stored in a sqlite3 database"""
-    def __init__(self, conn, run_migrations=True):
+
+    # the brain/schema version created by init()
+    VERSION = "3"
+
+    # Stamp recorded in the info table once _run_migrations has been
+    # applied. Bump it when adding a migration.
+    MIGRATIONS = "1"
+
+    # Page cache and memory map sizes for read-only connections, which
+    # don't share the write-time concerns behind cache_size=0.
+    READONLY_CACHE_KB = 16384
+    READONLY_MMAP_SIZE = 256 * 1024 * 1024
+
+    # The number of edge text lengths kept for length-limited replies
+    EDGE_LENGTH_CACHE_SIZE = 65536
+
+    # The number of nodes' distances to the end context kept in memory
+    END_DISTANCE_CACHE_SIZE = 65536
+
+    def __init__(self, conn, run_migrations=True, readonly=False):
         self._conn = conn
         conn.row_factory = sqlite3.Row
 
+        self.readonly = readonly
+
+        self._stem_cache = None
+        self._adjacency_cache = None
+        self._edge_lengths = LRUCache(self.EDGE_LENGTH_CACHE_SIZE)
+        self._end_distance_cache = LRUCache(self.END_DISTANCE_CACHE_SIZE)
+        self._end_distances = False
+        self._staging = False
+        self._staged_paths = []
+
         if self.is_initted():
-            if run_migrations:
+            self._end_distances = \
+                self.get_info_text("end_distances") == "current"
+
+            if readonly:
+                self._set_order(int(self.get_info_text("order")),
+                                self.get_info_text("node_key") == "packed")
+
+                c = self.cursor()
+                c.execute("PRAGMA query_only=1")
+                c.execute("PRAGMA cache_size=-%d" % self.READONLY_CACHE_KB)
+                c.execute("PRAGMA mmap_size=%d" % self.READONLY_MMAP_SIZE)
+                return
+
+            if run_migrations and \
+                    self.get_info_text("migrations") != self.MIGRATIONS:
                 self._run_migrations()
+                self.commit()
 
-            self.order = int(self.get_info_text("order"))
+            self._set_order(int(self.get_info_text("order")),
+                            self.get_info_text("node_key") == "packed")
 
-            self._all_tokens = ",".join(["token%d_id" % i
-                                         for i in range(self.order)])
-            self._all_tokens_args = " AND ".join(
-                ["token%d_id = ?" % i for i in range(self.order)])
-            self._all_tokens_q = ",".join(["?" for i in range(self.order)])
-            self._last_token = "token%d_id" % (self.order - 1)
+            if self.get_info_text("node_counts") == "stale":
+                self._repair_batch()
 
             # Disable the SQLite cache. Its pages tend to get swapped
             # out, even if the database file is in buffer cache.
@@ -462,16 +1640,69 @@ class Graph:
             c.execute("PRAGMA temp_store=memory")
             c.execute("PRAGMA synchronous=OFF")
 
+    def _set_order(self, order, packed_keys=False):
+        self.order = order
+        self.packed_keys = packed_keys
+
+        self._conn.create_function("cobe_node_key", order, pack_node_key,
+                                   deterministic=True)
+        self._conn.create_function("cobe_node_token", 2, _node_key_token,
+                                   deterministic=True)
+
+        # SQL expressions for each token id of a node. Packed brains
+        # only store the key, so their token ids are unpacked from it.
+        self._node_tokens = self._token_exprs(order, packed_keys)
+
+        self._all_tokens = ",".join(self._node_tokens)
+        self._all_tokens_args = " AND ".join(
+            ["token%d_id = ?" % i for i in range(self.order)])
+        self._all_tokens_q = ",".join(["?" for i in range(self.order)])
+        self._last_token = self._node_tokens[-1]
+
+        # nodes sort by their token ids, which the keys of a packed
+        # brain already do
+        if packed_keys:
+            self._node_order = "key"
+        else:
+            self._node_order = self._all_tokens
+
+    @staticmethod
+    def _token_exprs(order, packed_keys, table=None):
+        prefix = table + "." if table else ""
+
+        if packed_keys:
+            return ["cobe_node_token(%skey, %d)" % (prefix, i)
+                    for i in range(order)]
+
+        return ["%stoken%d_id" % (prefix, i) for i in range(order)]
+
     def cursor(self):
         return self._conn.cursor()
 
     def commit(self):
+        if self._staging:
+            self._flush_staged_edges()
+
         with trace_us("Brain.db_commit_us"):
             self._conn.commit()
 
+    def size_bytes(self):
+        c = self.cursor()
+        page_count = c.execute("PRAGMA page_count").fetchone()[0]
+        page_size = c.execute("PRAGMA page_size").fetchone()[0]
+
+        return page_count * page_size
+
     def close(self):
         return self._conn.close()
 
+    def total_changes(self):
+        return self._conn.total_changes
+
+    def backup(self, conn):
+        """Copy this graph's database into the connection conn."""
+        self._conn.backup(conn)
+
     def is_initted(self):
         try:
             self.get_info_text("order")
@@ -479,6 +1710,19 @@ class Graph:
         except sqlite3.OperationalError:
             return False
 
+    @staticmethod
+    def read_version(conn):
+        """Read the schema version of the brain on conn, without the
+        setup done when constructing a Graph."""
+        try:
+            row = conn.execute("SELECT text FROM info "
+                               "WHERE attribute = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+        if row is not None:
+            return row[0]
+
     def set_info_text(self, attribute, text):
         c = self.cursor()
 
@@ -543,15 +1787,215 @@ class Graph:
 
             return token_id
 
+    def get_token_ids(self, texts, stemmer=None):
+        """Return a dict mapping each of texts to its token id,
+        creating the tokens that don't exist yet. New tokens are
+        created in the order their texts first appear, so the same
+        input always gives the same ids."""
+        texts = list(dict.fromkeys(texts))
+        token_ids = self._select_token_ids(texts)
+
+        new = [text for text in texts if text not in token_ids]
+        if not new:
+            return token_ids
+
+        q = "INSERT INTO tokens (text, is_word) VALUES (?, ?)"
+        self._conn.executemany(q, [(text, bool(re.search(r"\w", text)))
+                                   for text in new])
+
+        new_ids = self._select_token_ids(new)
+        token_ids.update(new_ids)
+
+        if stemmer is not None:
+            stems = [(new_ids[text], stemmer.stem(text)) for text in new]
+            stems = [(token_id, stem) for token_id, stem in stems
+                     if stem is not None]
+
+            q = "INSERT INTO token_stems (token_id, stem) VALUES (?, ?)"
+            self._conn.executemany(q, stems)
+
+            if self._stem_cache is not None:
+                for token_id, stem in stems:
+                    cached = self._stem_cache.get(stem)
+                    if cached is not None:
+                        self._stem_cache.put(stem, cached + [token_id])
+
+        return token_ids
+
+    def _select_token_ids(self, texts):
+        # Look up the existing tokens of texts a chunk at a time, to
+        # stay under SQLite's limit on query parameters
+        token_ids = {}
+        for chunk in _chunked(texts, 500):
+            q = "SELECT text, id FROM tokens WHERE text IN (%s)" % \
+                ",".join(["?"] * len(chunk))
+            token_ids.update(self._conn.execute(q, chunk))
+
+        return token_ids
+
+    def enable_stem_cache(self, maxsize):
+        """Keep up to maxsize stems and their token ids in memory. The
+        cache is filled lazily as stems are looked up. A maxsize of
+        None turns the cache off."""
+        if not maxsize:
+            self._stem_cache = None
+            return
+
+        self._stem_cache = LRUCache(maxsize)
+
+    def enable_adjacency_cache(self, max_edges):
+        """Keep the edges around recently visited nodes in memory, up
+        to about max_edges edges. Each node's outgoing and incoming
+        edges are loaded on first use and evicted least recently used
+        first. A max_edges of None turns the cache off."""
+        if not max_edges:
+            self._adjacency_cache = None
+            return
+
+        self._adjacency_cache = LRUCache(
+            max_edges, sizeof=lambda entry: len(entry[1]) + 1,
+            on_evict=self._unindex_adjacency)
+
+        # edge id -> (node, direction) of a cache entry holding it
+        self._adjacency_edges = {}
+
+    def clear_caches(self):
+        self._edge_lengths.clear()
+        self._end_distance_cache.clear()
+
+        if self._stem_cache is not None:
+            self._stem_cache.clear()
+
+        if self._adjacency_cache is not None:
+            self._adjacency_cache.clear()
+            self._adjacency_edges.clear()
+
+    def _unindex_adjacency(self, key, entry):
+        index = self._adjacency_edges
+        for row in entry[1]:
+            if index.get(row[0]) == key:
+                del index[row[0]]
+
+    def _forget_adjacency(self, node, direction):
+        key = (node, direction)
+        entry = self._adjacency_cache.pop(key)
+        if entry is not None:
+            self._unindex_adjacency(key, entry)
+
+    def _query_adjacent(self, node, direction):
+        if direction:
+            q = "SELECT id, next_node, count, has_space FROM edges " \
+                "WHERE prev_node = ?"
+        else:
+            q = "SELECT id, prev_node, count, has_space FROM edges " \
+                "WHERE next_node = ?"
+
+        return [tuple(row) for row in self._conn.execute(q, (node,))]
+
+    def _cached_adjacency(self, node, direction):
+        # Return the (node count, rows) cache entry for a node,
+        # loading it if necessary. The node count is only needed (and
+        # only loaded) for outgoing edges, as the denominator of their
+        # probabilities.
+        key = (node, direction)
+        entry = self._adjacency_cache.get(key)
+        if entry is not None:
+            return entry
+
+        rows = self._query_adjacent(node, direction)
+
+        node_count = None
+        if direction:
+            row = self._conn.execute("SELECT count FROM nodes WHERE id = ?",
+                                     (node,)).fetchone()
+            node_count = row and row[0]
+
+        entry = (node_count, rows)
+        self._adjacency_cache.put(key, entry)
+
+        index = self._adjacency_edges
+        for row in rows:
+            index[row[0]] = key
+
+        return entry
+
+    def _cached_edge(self, edge_id):
+        # Return (node, direction, row) for a cached edge, or None.
+        key = self._adjacency_edges.get(edge_id)
+        if key is None:
+            return None
+
+        entry = self._adjacency_cache.get(key)
+        for row in entry[1]:
+            if row[0] == edge_id:
+                return key[0], key[1], row
+
+    def get_adjacent(self, node, direction):
+        """Return the edges leaving node (direction=1) or arriving at
+        it (direction=0), as (edge_id, other node, count, has_space)
+        tuples."""
+        if self._adjacency_cache is not None:
+            return self._cached_adjacency(node, direction)[1]
+
+        return self._query_adjacent(node, direction)
+
+    def get_adjacent_info(self, node, direction):
+        """Return get_adjacent's rows for node, each followed by the
+        edge's logprob and length (see get_edge_logprob and
+        get_edge_length). Without the adjacency cache, all of them
+        come from a single query."""
+        if self._adjacency_cache is not None:
+            return [row + (self.get_edge_logprob(row[0]),
+                           self.get_edge_length(row[0]))
+                    for row in self.get_adjacent(node, direction)]
+
+        if direction:
+            other, near = "next_node", "prev_node"
+        else:
+            other, near = "prev_node", "next_node"
+
+        q = "SELECT edges.id, edges.%s, edges.count, edges.has_space, " \
+            "nodes.count, length(tokens.text) + edges.has_space " \
+            "FROM edges, nodes, tokens WHERE edges.%s = ? " \
+            "AND nodes.id = edges.prev_node AND tokens.id = %s" % \
+            (other, near, self._last_token)
+
+        log = math.log
+        lengths = self._edge_lengths
+
+        rows = []
+        for edge_id, other_id, count, has_space, node_count, length \
+                in self._conn.execute(q, (node,)):
+            lengths.put(edge_id, length)
+            rows.append((edge_id, other_id, count, has_space,
+                         log(count, 2) - log(node_count, 2), length))
+
+        return rows
+
     def insert_stem(self, token_id, stem):
         q = "INSERT INTO token_stems (token_id, stem) VALUES (?, ?)"
         self._conn.execute(q, (token_id, stem))
 
+        if self._stem_cache is not None:
+            token_ids = self._stem_cache.get(stem)
+            if token_ids is not None:
+                self._stem_cache.put(stem, token_ids + [token_id])
+
     def get_token_stem_id(self, stem):
+        if self._stem_cache is not None:
+            token_ids = self._stem_cache.get(stem)
+            if token_ids is not None:
+                return list(token_ids)
+
         q = "SELECT token_id FROM token_stems WHERE token_stems.stem = ?"
         rows = self._conn.execute(q, (stem,))
         if rows:
-            return list(map(operator.itemgetter(0), rows))
+            token_ids = list(map(operator.itemgetter(0), rows))
+
+            if self._stem_cache is not None:
+                self._stem_cache.put(stem, token_ids)
+
+            return list(token_ids)
 
     def get_word_tokens(self, token_ids):
         q = "SELECT id FROM tokens WHERE id IN %s AND is_word = 1" % \
@@ -569,28 +2013,54 @@ class Graph:
         if rows:
             return list(map(operator.itemgetter(0), rows))
 
-    def get_node_by_tokens(self, tokens):
+    def get_node_by_tokens(self, tokens, create=True):
         c = self.cursor()
 
-        q = "SELECT id FROM nodes WHERE %s" % self._all_tokens_args
+        if self.packed_keys:
+            key = pack_node_key(*tokens)
+            row = c.execute("SELECT id FROM nodes WHERE key = ?",
+                            (key,)).fetchone()
+        else:
+            q = "SELECT id FROM nodes WHERE %s" % self._all_tokens_args
+            row = c.execute(q, tokens).fetchone()
 
-        row = c.execute(q, tokens).fetchone()
         if row:
             return int(row[0])
+        elif not create:
+            return None
 
         # if not found, create the node
-        q = "INSERT INTO nodes (count, %s) " \
-            "VALUES (0, %s)" % (self._all_tokens, self._all_tokens_q)
-        c.execute(q, tokens)
+        if self.packed_keys:
+            c.execute("INSERT INTO nodes (count, key) VALUES (0, ?)", (key,))
+        else:
+            q = "INSERT INTO nodes (count, %s) " \
+                "VALUES (0, %s)" % (self._all_tokens, self._all_tokens_q)
+            c.execute(q, tokens)
+
         return c.lastrowid
 
     def get_text_by_edge(self, edge_id):
         q = "SELECT tokens.text, edges.has_space FROM nodes, edges, tokens " \
             "WHERE edges.id = ? AND edges.prev_node = nodes.id " \
-            "AND nodes.%s = tokens.id" % self._last_token
+            "AND tokens.id = %s" % self._last_token
 
         return self._conn.execute(q, (edge_id,)).fetchone()
 
+    def get_edge_length(self, edge_id):
+        """Return the number of characters edge_id adds to the text of
+        a reply: its word and the space after it, if any."""
+        length = self._edge_lengths.get(edge_id)
+        if length is None:
+            q = "SELECT length(tokens.text) + edges.has_space " \
+                "FROM nodes, edges, tokens " \
+                "WHERE edges.id = ? AND edges.prev_node = nodes.id " \
+                "AND tokens.id = %s" % self._last_token
+
+            length = self._conn.execute(q, (edge_id,)).fetchone()[0]
+            self._edge_lengths.put(edge_id, length)
+
+        return length
+
     def get_random_token(self):
         # token 1 is the end_token_id, so we want to generate a random token
         # id from 2..max(id) inclusive.
@@ -599,22 +2069,55 @@ class Graph:
         if row:
             return row[0]
 
-    def get_random_node_with_token(self, token_id):
-        c = self.cursor()
+    def _token_nodes_where(self, token_id):
+        # A WHERE clause matching the nodes that start with token_id
+        if self.packed_keys:
+            # search the range of keys prefixed with token_id
+            return "key >= :lo AND key < :hi", \
+                dict(lo=pack_node_key(token_id),
+                     hi=pack_node_key(token_id + 1))
 
-        q = "SELECT id FROM nodes WHERE token0_id = ? " \
-            "LIMIT 1 OFFSET abs(random())%(SELECT count(*) FROM nodes " \
-            "                              WHERE token0_id = ?)"
+        return "token0_id = :token", dict(token=token_id)
 
-        row = c.execute(q, (token_id, token_id)).fetchone()
+    def get_token_node_count(self, token_id):
+        """Return the number of nodes that start with token_id."""
+        where, args = self._token_nodes_where(token_id)
+
+        q = "SELECT count(*) FROM nodes WHERE %s" % where
+        return self._conn.execute(q, args).fetchone()[0]
+
+    def get_token_node(self, token_id, index):
+        """Return the index'th node that starts with token_id, in node
+        key order, or None if there are fewer nodes than that."""
+        where, args = self._token_nodes_where(token_id)
+        args["index"] = index
+
+        q = "SELECT id FROM nodes WHERE %s LIMIT 1 OFFSET :index" % where
+        row = self._conn.execute(q, args).fetchone()
         if row:
             return int(row[0])
 
+    def get_random_node_with_token(self, token_id):
+        count = self.get_token_node_count(token_id)
+        if count:
+            return self.get_token_node(token_id, random.randrange(count))
+
     def get_edge_logprob(self, edge_id):
         # Each edge goes from an n-gram node (word1, word2, word3) to
         # another (word2, word3, word4). Calculate the probability:
         # P(word4|word1,word2,word3) = count(edge_id) / count(prev_node_id)
 
+        if self._adjacency_cache is not None:
+            cached = self._cached_edge(edge_id)
+            if cached is not None:
+                node, direction, row = cached
+
+                # the count of the edge's prev_node is kept with its
+                # outgoing edges
+                prev_node = node if direction else row[1]
+                node_count = self._cached_adjacency(prev_node, 1)[0]
+                return math.log(row[2], 2) - math.log(node_count, 2)
+
         c = self.cursor()
         q = "SELECT edges.count, nodes.count FROM edges, nodes " \
             "WHERE edges.id = ? AND edges.prev_node = nodes.id"
@@ -623,6 +2126,11 @@ class Graph:
         return math.log(edge_count, 2) - math.log(node_count, 2)
 
     def has_space(self, edge_id):
+        if self._adjacency_cache is not None:
+            cached = self._cached_edge(edge_id)
+            if cached is not None:
+                return bool(cached[2][3])
+
         c = self.cursor()
 
         q = "SELECT has_space FROM edges WHERE id = ?"
@@ -631,27 +2139,304 @@ class Graph:
         if row:
             return bool(row[0])
 
+    def add_edges(self, edges):
+        """Add learned edges, given as a mapping of (prev_node,
+        next_node, has_space) keys to the number of times each was
+        learned. They're written in key order."""
+        table = "edges"
+        if self._staging:
+            table = "temp.staged_edges"
+
+        q = "INSERT INTO %s (prev_node, next_node, has_space, count) " \
+            "VALUES (?, ?, ?, ?) " \
+            "ON CONFLICT (prev_node, next_node, has_space) " \
+            "DO UPDATE SET count = count + excluded.count" % table
+
+        self._conn.executemany(q, [key + (count,) for key, count
+                                   in sorted(edges.items())])
+
+        if self._adjacency_cache is not None and not self._staging:
+            for prev_node, next_node, has_space in edges:
+                self._forget_adjacency(prev_node, 1)
+                self._forget_adjacency(next_node, 0)
+                self._forget_adjacency(next_node, 1)
+
     def add_edge(self, prev_node, next_node, has_space):
         c = self.cursor()
 
         assert type(has_space) == bool
 
-        update_q = "UPDATE edges SET count = count + 1 " \
-            "WHERE prev_node = ? AND next_node = ? AND has_space = ?"
+        if self._staging:
+            q = "INSERT INTO temp.staged_edges " \
+                "(prev_node, next_node, has_space, count) " \
+                "VALUES (?, ?, ?, 1) " \
+                "ON CONFLICT (prev_node, next_node, has_space) " \
+                "DO UPDATE SET count = count + 1"
+            c.execute(q, (prev_node, next_node, has_space))
+            return
 
+        # A repeated edge is found through edges_key and has its
+        # count updated in place. count isn't part of any index, so
+        # only the table row is written.
         q = "INSERT INTO edges (prev_node, next_node, has_space, count) " \
-            "VALUES (?, ?, ?, 1)"
+            "VALUES (?, ?, ?, 1) " \
+            "ON CONFLICT (prev_node, next_node, has_space) " \
+            "DO UPDATE SET count = count + 1"
 
-        args = (prev_node, next_node, has_space)
+        c.execute(q, (prev_node, next_node, has_space))
 
-        c.execute(update_q, args)
-        if c.rowcount == 0:
-            c.execute(q, args)
+        if self._adjacency_cache is not None:
+            # The edge's count has changed in the entries holding it,
+            # and so has the count of next_node.
+            self._forget_adjacency(prev_node, 1)
+            self._forget_adjacency(next_node, 0)
+            self._forget_adjacency(next_node, 1)
 
         # The count on the next_node in the nodes table must be
         # incremented here, to register that the node has been seen an
         # additional time. This is now handled by database triggers.
 
+    def _upsert_edges(self, rows_q, args=()):
+        """Add the (prev_node, next_node, has_space, count) rows
+        selected by rows_q to the edges table, in key order. Existing
+        edges have their counts increased, and new edges are numbered
+        after the current largest edge id."""
+        self._conn.execute("""
+INSERT INTO edges (prev_node, next_node, has_space, count)
+    SELECT prev_node, next_node, has_space, count
+    FROM (%s)
+    WHERE true
+    ORDER BY prev_node, next_node, has_space
+ON CONFLICT (prev_node, next_node, has_space)
+DO UPDATE SET count = count + excluded.count""" % rows_q, tuple(args))
+
+    def start_staging(self):
+        """Collect learned edges in a temporary table, to be merged
+        into the edges table in key order on each commit."""
+        self._conn.execute("""
+CREATE TEMP TABLE IF NOT EXISTS staged_edges (
+    prev_node INTEGER NOT NULL,
+    next_node INTEGER NOT NULL,
+    has_space INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (prev_node, next_node, has_space)) WITHOUT ROWID""")
+        self._staging = True
+
+    def stop_staging(self):
+        self.commit()
+
+        self._staging = False
+        self._conn.execute("DROP TABLE IF EXISTS temp.staged_edges")
+
+    def _flush_staged_edges(self):
+        with trace_ms("Db.flush_staged_edges_ms"):
+            self._upsert_edges("SELECT prev_node, next_node, has_space, "
+                               "count FROM temp.staged_edges")
+            self._conn.execute("DELETE FROM temp.staged_edges")
+
+        self.clear_caches()
+
+        # relax the end distances along the paths just merged
+        with trace_ms("Db.relax_staged_paths_ms"):
+            for path in self._staged_paths:
+                self._relax_end_distances(path)
+            self._staged_paths = []
+
+    def _id_ranges(self, table, batch_size):
+        # Split the ids of table into [lo, hi) ranges of batch_size
+        row = self._conn.execute("SELECT max(id) FROM %s" % table).fetchone()
+        max_id = row[0] or 0
+
+        for lo in range(0, max_id + 1, batch_size):
+            yield lo, lo + batch_size
+
+    def delete_rare_edges(self, min_count, batch_size):
+        """Delete all edges with a count lower than min_count. Node
+        counts are kept up to date by edges_delete_trigger."""
+        q = "DELETE FROM edges WHERE prev_node >= ? AND prev_node < ? " \
+            "AND count < ?"
+
+        deleted = 0
+        for lo, hi in self._id_ranges("nodes", batch_size):
+            deleted += self._conn.execute(q, (lo, hi, min_count)).rowcount
+            self.commit()
+
+        self.clear_caches()
+        return deleted
+
+    def delete_orphan_nodes(self, batch_size, keep=()):
+        """Delete all nodes that have no incoming or outgoing edges,
+        except those with ids in keep."""
+        q = "DELETE FROM nodes WHERE id >= ? AND id < ? " \
+            "AND id NOT IN %s " \
+            "AND NOT EXISTS (SELECT 1 FROM edges " \
+            "                WHERE prev_node = nodes.id) " \
+            "AND NOT EXISTS (SELECT 1 FROM edges " \
+            "                WHERE next_node = nodes.id)" % \
+            self.get_seq_expr(list(keep) or [0])
+
+        deleted = 0
+        for lo, hi in self._id_ranges("nodes", batch_size):
+            deleted += self._conn.execute(q, (lo, hi)).rowcount
+            self.commit()
+
+        return deleted
+
+    def delete_unused_tokens(self, batch_size, keep=()):
+        """Delete all tokens not found in any node, and their stems,
+        except those with ids in keep."""
+        c = self.cursor()
+
+        # Collect the referenced tokens in a pass over nodes for each
+        # token position, since at most the first token is indexed.
+        c.execute("DROP TABLE IF EXISTS temp.used_tokens")
+        c.execute("CREATE TEMP TABLE used_tokens (id INTEGER PRIMARY KEY)")
+        for token in self._node_tokens:
+            c.execute("INSERT OR IGNORE INTO used_tokens "
+                      "SELECT %s FROM nodes" % token)
+
+        q = "DELETE FROM tokens WHERE id >= ? AND id < ? " \
+            "AND id NOT IN %s " \
+            "AND id NOT IN (SELECT id FROM temp.used_tokens)" % \
+            self.get_seq_expr(list(keep) or [0])
+
+        deleted = 0
+        for lo, hi in self._id_ranges("tokens", batch_size):
+            deleted += c.execute(q, (lo, hi)).rowcount
+            self.commit()
+
+        c.execute("DELETE FROM token_stems WHERE token_id NOT IN "
+                  "(SELECT id FROM tokens)")
+        c.execute("DROP TABLE temp.used_tokens")
+        self.commit()
+
+        self.clear_caches()
+        return deleted
+
+    def merge(self, filename, stemmer=None):
+        """Merge the graph in another brain file into this one.
+
+Tokens, nodes and edges are copied with set-based INSERT ... SELECT
+statements, sorted on this graph's keys, so the merge streams through
+both databases rather than looking up each row from Python."""
+        # ATTACH can't run inside a transaction
+        self.commit()
+
+        # the other brain is only read
+        uri = "file:%s?mode=ro" % urllib.parse.quote(
+            os.path.abspath(filename))
+
+        c = self.cursor()
+        c.execute("ATTACH DATABASE ? AS src", (uri,))
+
+        try:
+            self._merge_attached(stemmer)
+        except Exception:
+            self._conn.rollback()
+            raise
+        finally:
+            c.execute("DROP TABLE IF EXISTS temp.token_map")
+            c.execute("DROP TABLE IF EXISTS temp.node_map")
+            c.execute("DETACH DATABASE src")
+
+    def _merge_attached(self, stemmer):
+        c = self.cursor()
+
+        q = "SELECT text FROM src.info WHERE attribute = ?"
+        for attribute in ("version", "order", "tokenizer"):
+            theirs = c.execute(q, (attribute,)).fetchone()
+            theirs = theirs and theirs[0]
+            ours = self.get_info_text(attribute)
+
+            if theirs != ours:
+                raise CobeError("cannot merge a brain with %s %s into "
+                                "one with %s %s" % (attribute, theirs,
+                                                    attribute, ours))
+
+        c.execute("BEGIN")
+
+        with trace_ms("Db.merge_tokens_ms"):
+            max_token_id = c.execute(
+                "SELECT coalesce(max(id), 0) FROM tokens").fetchone()[0]
+
+            c.execute("""
+INSERT OR IGNORE INTO main.tokens (text, is_word)
+    SELECT text, is_word FROM src.tokens ORDER BY text""")
+
+            c.execute("""
+CREATE TEMP TABLE token_map (
+    src_id INTEGER PRIMARY KEY,
+    dst_id INTEGER NOT NULL)""")
+            c.execute("""
+INSERT INTO token_map (src_id, dst_id)
+    SELECT s.id, d.id FROM src.tokens s, main.tokens d
+    WHERE d.text = s.text""")
+
+            if stemmer is not None:
+                self._stem_new_tokens(stemmer, max_token_id)
+
+        # Join each source node's tokens through token_map, then find
+        # the matching node here through its unique key.
+        q = "SELECT text FROM src.info WHERE attribute = 'node_key'"
+        src_packed = c.execute(q).fetchone() is not None
+        src_tokens = self._token_exprs(self.order, src_packed, "n")
+
+        joins = " ".join(["JOIN token_map m%d ON m%d.src_id = %s"
+                          % (i, i, token)
+                          for i, token in enumerate(src_tokens)])
+        mapped = ",".join(["m%d.dst_id" % i for i in range(self.order)])
+
+        with trace_ms("Db.merge_nodes_ms"):
+            # New nodes start with a count of zero. The triggers add
+            # the counts of their incoming edges as those are merged.
+            if self.packed_keys:
+                c.execute("""
+INSERT OR IGNORE INTO main.nodes (count, key)
+    SELECT 0, cobe_node_key(%s) FROM src.nodes n %s ORDER BY %s""" % (
+                    mapped, joins, mapped))
+
+                matches = "d.key = cobe_node_key(%s)" % mapped
+            else:
+                c.execute("""
+INSERT OR IGNORE INTO main.nodes (count, %s)
+    SELECT 0, %s FROM src.nodes n %s ORDER BY %s""" % (
+                    self._all_tokens, mapped, joins, mapped))
+
+                matches = " AND ".join(["d.token%d_id = m%d.dst_id" % (i, i)
+                                        for i in range(self.order)])
+
+            c.execute("""
+CREATE TEMP TABLE node_map (
+    src_id INTEGER PRIMARY KEY,
+    dst_id INTEGER NOT NULL)""")
+            c.execute("""
+INSERT INTO node_map (src_id, dst_id)
+    SELECT n.id, d.id FROM src.nodes n %s JOIN main.nodes d ON %s""" % (
+                joins, matches))
+
+        with trace_ms("Db.merge_edges_ms"):
+            self._upsert_edges("""
+SELECT p.dst_id AS prev_node, n.dst_id AS next_node,
+       e.has_space AS has_space, e.count AS count
+FROM src.edges e
+JOIN node_map p ON p.src_id = e.prev_node
+JOIN node_map n ON n.src_id = e.next_node""")
+
+        self.commit()
+        self.clear_caches()
+
+    def _stem_new_tokens(self, stemmer, min_id):
+        c = self.cursor()
+
+        q = "SELECT id, text FROM tokens WHERE id > ?"
+        for token_id, text in c.execute(q, (min_id,)).fetchall():
+            stem = stemmer.stem(text)
+            if stem is not None:
+                self.insert_stem(token_id, stem)
+
+    def vacuum(self):
+        self._conn.execute("VACUUM")
+
     def search_bfs(self, start_id, end_id, direction):
         if direction:
             q = "SELECT id, next_node FROM edges WHERE prev_node = ?"
@@ -673,25 +2458,45 @@ class Graph:
                 else:
                     left.append((next, newpath))
 
-    def search_random_walk(self, start_id, end_id, direction):
-        """Walk once randomly from start_id to end_id."""
+    def search_random_walk(self, start_id, end_id, direction,
+                           max_len=None):
+        """Walk once randomly from start_id to end_id. If max_len is
+        set, the walk is abandoned as soon as its text is longer than
+        max_len characters."""
+        if self._adjacency_cache is not None:
+            yield from self._search_random_walk_cached(start_id, end_id,
+                                                       direction, max_len)
+            return
+
         if direction:
-            q = "SELECT id, next_node " \
-                "FROM edges WHERE prev_node = :last " \
-                "LIMIT 1 OFFSET abs(random())%(SELECT count(*) from edges " \
-                "                              WHERE prev_node = :last)"
+            near, far, column = "prev_node", "next_node", "forward"
         else:
-            q = "SELECT id, prev_node " \
-                "FROM edges WHERE next_node = :last " \
-                "LIMIT 1 OFFSET abs(random())%(SELECT count(*) from edges " \
-                "                              WHERE next_node = :last)"
+            near, far, column = "next_node", "prev_node", "backward"
+
+        edges = "FROM edges WHERE %s = :last" % near
+        if self._end_distances:
+            # only step to nodes that can reach end_id in the budget
+            edges = "FROM edges JOIN node_distances " \
+                    "ON node_distances.id = edges.%s " \
+                    "WHERE edges.%s = :last " \
+                    "AND node_distances.%s <= coalesce(:hops, %s)" % \
+                    (far, near, column, column)
+
+        # A node without edges (left by prune) has no row to offset
+        # to, and taking the offset modulo 0 would make it NULL.
+        q = "SELECT edges.id, edges.%s %s " \
+            "LIMIT 1 OFFSET abs(random())%%max(1, (SELECT count(*) %s))" % \
+            (far, edges, edges)
 
         c = self.cursor()
 
+        length = 0
+
         left = collections.deque([(start_id, tuple())])
         while left:
             cur, path = left.popleft()
-            rows = c.execute(q, dict(last=cur))
+            hops = self._end_budget(max_len, length)
+            rows = c.execute(q, dict(last=cur, hops=hops))
 
             # Note: the LIMIT 1 above means this list only contains
             # one row. Using a list here so this matches the bfs()
@@ -700,12 +2505,45 @@ class Graph:
             for rowid, next in rows:
                 newpath = path + (rowid,)
 
+                if max_len is not None:
+                    length += self.get_edge_length(rowid)
+                    if length > max_len:
+                        return
+
                 if next == end_id:
                     yield newpath
                 else:
                     left.append((next, newpath))
 
-    def init(self, order, tokenizer, run_migrations=True):
+    def _search_random_walk_cached(self, start_id, end_id, direction,
+                                   max_len=None):
+        cur = start_id
+        path = tuple()
+        length = 0
+
+        while True:
+            rows = self._cached_adjacency(cur, direction)[1]
+            if self._end_distances:
+                rows = self.reachable_edges(rows, direction, max_len, length)
+
+            if not rows:
+                return
+
+            row = random.choice(rows)
+            path = path + (row[0],)
+            cur = row[1]
+
+            if max_len is not None:
+                length += self.get_edge_length(row[0])
+                if length > max_len:
+                    return
+
+            if cur == end_id:
+                yield path
+                return
+
+    def init(self, order, tokenizer, run_migrations=True, end_token=None,
+             packed_keys=False):
         c = self.cursor()
 
         log.debug("Creating table: info")
@@ -717,13 +2555,15 @@ CREATE TABLE info (
         log.debug("Creating table: tokens")
         c.execute("""
 CREATE TABLE tokens (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER PRIMARY KEY,
     text TEXT UNIQUE NOT NULL,
     is_word INTEGER NOT NULL)""")
 
-        tokens = []
-        for i in range(order):
-            tokens.append("token%d_id INTEGER REFERENCES token(id)" % i)
+        if packed_keys:
+            tokens = ["key BLOB NOT NULL"]
+        else:
+            tokens = ["token%d_id INTEGER REFERENCES token(id)" % i
+                      for i in range(order)]
 
         log.debug("Creating table: token_stems")
         c.execute("""
@@ -734,63 +2574,198 @@ CREATE TABLE token_stems (
         log.debug("Creating table: nodes")
         c.execute("""
 CREATE TABLE nodes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER PRIMARY KEY,
     count INTEGER NOT NULL,
     %s)""" % ',\n    '.join(tokens))
 
         log.debug("Creating table: edges")
-        c.execute("""
-CREATE TABLE edges (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    prev_node INTEGER NOT NULL REFERENCES nodes(id),
-    next_node INTEGER NOT NULL REFERENCES nodes(id),
-    count INTEGER NOT NULL,
-    has_space INTEGER NOT NULL)""")
+        self._create_edges_table("edges")
 
         if run_migrations:
             self._run_migrations()
 
         # save the order of this brain
         self.set_info_text("order", str(order))
-        self.order = order
+        self._set_order(order, packed_keys)
+
+        if packed_keys:
+            self.set_info_text("node_key", "packed")
 
         # save the tokenizer
         self.set_info_text("tokenizer", tokenizer)
 
         # save the brain/schema version
-        self.set_info_text("version", "2")
+        self.set_info_text("version", self.VERSION)
 
         self.commit()
         self.ensure_indexes()
 
+        if end_token is not None:
+            # create the end token and the end context node, so
+            # opening the brain doesn't need to write
+            end_token_id = self.get_token_by_text(end_token, create=True)
+            self.get_node_by_tokens([end_token_id] * order)
+            self.commit()
+
         self.close()
 
+    def _create_edges_table(self, name):
+        # Edges are keyed on their id, which replies are built from,
+        # so scoring and text lookups are a single rowid search. The
+        # (prev_node, next_node, has_space) key is a unique index and
+        # next_node has its own index for backward walks, both created
+        # by ensure_indexes: three B-trees per edge in all.
+        #
+        # A WITHOUT ROWID table clustered on the key was tried. Since
+        # edges are looked up by id everywhere, it still needed a
+        # unique index on id, so it kept three B-trees, was larger,
+        # and took two searches per id lookup.
+        self._conn.execute("""
+CREATE TABLE %s (
+    id INTEGER PRIMARY KEY,
+    prev_node INTEGER NOT NULL REFERENCES nodes(id),
+    next_node INTEGER NOT NULL REFERENCES nodes(id),
+    has_space INTEGER NOT NULL,
+    count INTEGER NOT NULL)""" % name)
+
     def drop_reply_indexes(self):
         self._conn.execute("DROP INDEX IF EXISTS edges_all_next")
-        self._conn.execute("DROP INDEX IF EXISTS edges_all_prev")
-
-        self._conn.execute("""
-CREATE INDEX IF NOT EXISTS learn_index ON edges
-    (prev_node, next_node)""")
 
     def ensure_indexes(self):
         c = self.cursor()
 
-        # remove the temporary learning index if it exists
+        # remove the obsolete learning and reply indexes if they exist
         c.execute("DROP INDEX IF EXISTS learn_index")
+        c.execute("DROP INDEX IF EXISTS edges_all_prev")
 
-        token_ids = ",".join(["token%d_id" % i for i in range(self.order)])
-        c.execute("""
+        if self.packed_keys:
+            c.execute("""
+CREATE UNIQUE INDEX IF NOT EXISTS nodes_key on nodes (key)""")
+        else:
+            token_ids = ",".join(["token%d_id" % i
+                                  for i in range(self.order)])
+            c.execute("""
 CREATE UNIQUE INDEX IF NOT EXISTS nodes_token_ids on nodes
     (%s)""" % token_ids)
 
+        # Learning and the forward walk search by prev_node. The index
+        # carries the edge id, so it covers both without reading the
+        # table. It excludes count, so learning a repeated edge leaves
+        # it untouched.
         c.execute("""
-CREATE UNIQUE INDEX IF NOT EXISTS edges_all_next ON edges
-    (next_node, prev_node, has_space, count)""")
+CREATE UNIQUE INDEX IF NOT EXISTS edges_key ON edges
+    (prev_node, next_node, has_space)""")
 
+        # The reverse walk searches by next_node, and reads the rest of
+        # each edge from the table.
         c.execute("""
-CREATE UNIQUE INDEX IF NOT EXISTS edges_all_prev ON edges
-    (prev_node, next_node, has_space, count)""")
+CREATE INDEX IF NOT EXISTS edges_all_next ON edges (next_node)""")
+
+    def pack_node_keys(self):
+        """Switch an existing graph to packed node keys."""
+        if self.packed_keys:
+            return
+
+        with trace_ms("Db.pack_node_keys_ms"):
+            c = self.cursor()
+            c.execute("BEGIN")
+
+            # Rebuild nodes with only the key, since the token columns
+            # would take as much space again.
+            c.execute("DROP TRIGGER IF EXISTS edges_insert_trigger")
+            c.execute("DROP TRIGGER IF EXISTS edges_update_trigger")
+            c.execute("DROP TRIGGER IF EXISTS edges_delete_trigger")
+
+            c.execute("""
+CREATE TABLE nodes_packed (
+    id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL,
+    key BLOB NOT NULL)""")
+            c.execute("""
+INSERT INTO nodes_packed (id, count, key)
+    SELECT id, count, cobe_node_key(%s) FROM nodes ORDER BY id""" %
+                      self._all_tokens)
+            c.execute("DROP TABLE nodes")
+            c.execute("ALTER TABLE nodes_packed RENAME TO nodes")
+
+            self.set_info_text("node_key", "packed")
+            self._set_order(self.order, True)
+
+            self.ensure_indexes()
+            self._maybe_create_node_count_triggers()
+            self.commit()
+
+        with trace_ms("Db.pack_node_keys_vacuum_ms"):
+            self._conn.execute("VACUUM")
+
+    def upgrade(self):
+        """Upgrade a version 2 brain to the current schema in place."""
+        version = self.get_info_text("version")
+        if version == self.VERSION:
+            return
+
+        if version != "2":
+            raise CobeError("cannot upgrade a version %s brain" % version)
+
+        with trace_ms("Db.upgrade_ms"):
+            c = self.cursor()
+            c.execute("BEGIN")
+
+            # The node count triggers refer to the tables being
+            # rebuilt. They're recreated once the new tables are in
+            # place.
+            c.execute("DROP TRIGGER IF EXISTS edges_insert_trigger")
+            c.execute("DROP TRIGGER IF EXISTS edges_update_trigger")
+            c.execute("DROP TRIGGER IF EXISTS edges_delete_trigger")
+
+            # Rebuild tokens and nodes without AUTOINCREMENT, which
+            # saves a write to sqlite_sequence for every new row.
+            c.execute("""
+CREATE TABLE tokens_v3 (
+    id INTEGER PRIMARY KEY,
+    text TEXT UNIQUE NOT NULL,
+    is_word INTEGER NOT NULL)""")
+            c.execute("""
+INSERT INTO tokens_v3 (id, text, is_word)
+    SELECT id, text, is_word FROM tokens ORDER BY id""")
+            c.execute("DROP TABLE tokens")
+            c.execute("ALTER TABLE tokens_v3 RENAME TO tokens")
+
+            tokens = []
+            for i in range(self.order):
+                tokens.append("token%d_id INTEGER REFERENCES token(id)" % i)
+
+            c.execute("""
+CREATE TABLE nodes_v3 (
+    id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL,
+    %s)""" % ',\n    '.join(tokens))
+            c.execute("""
+INSERT INTO nodes_v3 (id, count, %s)
+    SELECT id, count, %s FROM nodes ORDER BY id""" % (self._all_tokens,
+                                                      self._all_tokens))
+            c.execute("DROP TABLE nodes")
+            c.execute("ALTER TABLE nodes_v3 RENAME TO nodes")
+
+            # Copy the edges in id order, so the new table is written
+            # sequentially.
+            self._create_edges_table("edges_v3")
+            c.execute("""
+INSERT INTO edges_v3 (id, prev_node, next_node, has_space, count)
+    SELECT id, prev_node, next_node, has_space, count FROM edges
+    ORDER BY id""")
+            c.execute("DROP TABLE edges")
+            c.execute("ALTER TABLE edges_v3 RENAME TO edges")
+
+            self.ensure_indexes()
+            self._run_migrations()
+
+            self.set_info_text("version", self.VERSION)
+            self.commit()
+
+        # reclaim the space used by the old tables
+        with trace_ms("Db.upgrade_vacuum_ms"):
+            self._conn.execute("VACUUM")
 
     def delete_token_stems(self):
         c = self.cursor()
@@ -802,10 +2777,16 @@ CREATE UNIQUE INDEX IF NOT EXISTS edges_all_prev ON edges
         # delete all the existing stems from the table
         c.execute("DELETE FROM token_stems")
 
+        if self._stem_cache is not None:
+            self._stem_cache.clear()
+
         self.commit()
 
     def update_token_stems(self, stemmer):
         # stemmer is a CobeStemmer
+        if self._stem_cache is not None:
+            self._stem_cache.clear()
+
         with trace_ms("Db.update_token_stems_ms"):
             c = self.cursor()
 
@@ -833,12 +2814,254 @@ CREATE INDEX token_stems_stem on token_stems (stem)""")
             self._maybe_drop_tokens_text_index()
             self._maybe_create_node_count_triggers()
 
+            self.set_info_text("migrations", self.MIGRATIONS)
+
     def _maybe_drop_tokens_text_index(self):
         # tokens_text was an index on tokens.text, deemed redundant since
         # tokens.text is declared UNIQUE, and sqlite automatically creates
         # indexes for UNIQUE columns
         self._conn.execute("DROP INDEX IF EXISTS tokens_text")
 
+    def _repair_batch(self):
+        # The node counts are flagged stale while a batch learn runs.
+        # If the process running it is gone, the batch was interrupted
+        # before it could rebuild the reply index and recompute the
+        # counts. The process check only sees this host, so a batch
+        # run elsewhere on a shared brain file is treated as live.
+        pid = self.get_info_text("batch_pid")
+        if pid is not None and _process_alive(int(pid)):
+            log.info("Batch learning in progress in process %s", pid)
+            return
+
+        log.warning("Repairing an interrupted batch learn")
+        self.ensure_indexes()
+        self.resume_node_counts()
+
+    def suspend_node_counts(self):
+        """Stop maintaining nodes.count as edges are learned, until
+        resume_node_counts is called. This removes a random write to
+        nodes for every learned edge."""
+        c = self.cursor()
+
+        # Flag the counts as stale in the same transaction, so they're
+        # repaired on the next open if resume_node_counts never runs.
+        self.set_info_text("node_counts", "stale")
+        self.set_info_text("batch_pid", str(os.getpid()))
+        c.execute("DROP TRIGGER IF EXISTS edges_insert_trigger")
+        c.execute("DROP TRIGGER IF EXISTS edges_update_trigger")
+        self.commit()
+
+    def resume_node_counts(self):
+        """Recompute nodes.count from the edges table and reinstall the
+        triggers that maintain it."""
+        with trace_ms("Db.recompute_node_counts_ms"):
+            # Nodes without incoming edges are left alone. Their
+            # count can't have changed while the triggers were gone.
+            self._conn.execute("""
+UPDATE nodes SET count = totals.count
+FROM (SELECT next_node, sum(count) AS count FROM edges
+      GROUP BY next_node) AS totals
+WHERE nodes.id = totals.next_node""")
+
+            self._maybe_create_node_count_triggers()
+            self.set_info_text("node_counts", None)
+            self.set_info_text("batch_pid", None)
+            self.commit()
+
+        self.clear_caches()
+
+    def has_end_distances(self):
+        """Return True if node_distances holds each node's current
+        distance to the end context."""
+        return self._end_distances
+
+    def update_end_distances(self, end_id):
+        """Compute the distance of every node to the end context node
+        end_id, in edges: forward (following edges) and backward
+        (against them). Nodes that can't reach end_id get NULL. Each
+        direction is a breadth first search from end_id, with one
+        query per level. Returns the number of nodes that reach end_id
+        forward and backward."""
+        c = self.cursor()
+
+        with trace_ms("Db.update_end_distances_ms"):
+            c.execute("DROP TABLE IF EXISTS node_distances")
+            c.execute("""
+CREATE TABLE node_distances (
+    id INTEGER PRIMARY KEY,
+    forward INTEGER,
+    backward INTEGER)""")
+            c.execute("INSERT INTO node_distances (id) SELECT id FROM nodes")
+
+            c.execute("CREATE TEMP TABLE distance_frontier "
+                      "(id INTEGER PRIMARY KEY)")
+            c.execute("CREATE TEMP TABLE distance_next "
+                      "(id INTEGER PRIMARY KEY)")
+
+            reached = []
+            for near, far, column in (("next_node", "prev_node", "forward"),
+                                      ("prev_node", "next_node", "backward")):
+                q = "INSERT OR IGNORE INTO temp.distance_next " \
+                    "SELECT edges.%s FROM temp.distance_frontier f " \
+                    "JOIN edges ON edges.%s = f.id " \
+                    "JOIN node_distances ON node_distances.id = edges.%s " \
+                    "WHERE node_distances.%s IS NULL" % \
+                    (far, near, far, column)
+
+                c.execute("UPDATE node_distances SET %s = 0 "
+                          "WHERE id = ?" % column, (end_id,))
+                c.execute("INSERT INTO temp.distance_frontier VALUES (?)",
+                          (end_id,))
+
+                count = 1
+                distance = 0
+                while c.execute(q).rowcount > 0:
+                    distance += 1
+                    count += c.execute(
+                        "UPDATE node_distances SET %s = ? WHERE id IN "
+                        "(SELECT id FROM temp.distance_next)" % column,
+                        (distance,)).rowcount
+
+                    c.execute("DELETE FROM temp.distance_frontier")
+                    c.execute("INSERT INTO temp.distance_frontier "
+                              "SELECT id FROM temp.distance_next")
+                    c.execute("DELETE FROM temp.distance_next")
+
+                c.execute("DELETE FROM temp.distance_frontier")
+                reached.append(count)
+
+            c.execute("DROP TABLE temp.distance_frontier")
+            c.execute("DROP TABLE temp.distance_next")
+
+            self.set_info_text("end_distances", "current")
+            self.commit()
+
+        self._end_distances = True
+        self._end_distance_cache.clear()
+
+        return tuple(reached)
+
+    def mark_end_distances_stale(self):
+        """Stop using the end distances until update_end_distances is
+        called again, for changes relax_end_distances can't follow."""
+        if self._end_distances:
+            self.set_info_text("end_distances", "stale")
+            self._end_distances = False
+
+    def drop_end_distances(self):
+        self._conn.execute("DROP TABLE IF EXISTS node_distances")
+        self.set_info_text("end_distances", None)
+        self.commit()
+
+        self._end_distances = False
+        self._end_distance_cache.clear()
+
+    def relax_end_distances(self, node_ids):
+        """Update the end distances after learning a path through
+        node_ids, which starts and ends at the end context. Learning
+        only adds edges, so distances can only shrink: the path bounds
+        each of its nodes' distances, and any node that gets closer
+        passes that on to its neighbors.
+
+        While staging, the path is kept until its edges are merged
+        into the edges table, so neighbors are found through them."""
+        if self._staging:
+            self._staged_paths.append(node_ids)
+        else:
+            self._relax_end_distances(node_ids)
+
+    def _relax_end_distances(self, node_ids):
+        c = self.cursor()
+
+        c.executemany("INSERT OR IGNORE INTO node_distances (id) VALUES (?)",
+                      [(node_id,) for node_id in node_ids])
+
+        # the current distances of the path's nodes, by id
+        known = {}
+        for chunk in _chunked(set(node_ids), 500):
+            q = "SELECT id, forward, backward FROM node_distances " \
+                "WHERE id IN (%s)" % ",".join(["?"] * len(chunk))
+            for node_id, forward, backward in c.execute(q, chunk):
+                known[node_id] = [backward, forward]
+
+        for path, near, far, column, direction in (
+                (node_ids[::-1], "next_node", "prev_node", "forward", 1),
+                (node_ids, "prev_node", "next_node", "backward", 0)):
+            put = "UPDATE node_distances SET %s = ? WHERE id = ?" % column
+            neighbors = "SELECT edges.%s, edges.%s, node_distances.%s " \
+                "FROM edges JOIN node_distances " \
+                "ON node_distances.id = edges.%s WHERE edges.%s IN (%%s)" % \
+                (far, near, column, far, near)
+
+            # the nodes that got closer, with their new distances
+            closer = {}
+
+            # the path's first node is the end context itself
+            bound = 0
+            for node_id in path[1:]:
+                bound += 1
+                distances = known[node_id]
+                distance = distances[direction]
+                if distance is not None and distance <= bound:
+                    bound = distance
+                    continue
+
+                distances[direction] = closer[node_id] = bound
+
+            # pass the new distances on, a level of neighbors at a time
+            while closer:
+                c.executemany(put, [(distance, node_id) for node_id, distance
+                                    in closer.items()])
+
+                changed, closer = closer, {}
+                for chunk in _chunked(changed, 500):
+                    for node_id in chunk:
+                        self._end_distance_cache.pop(node_id)
+
+                    q = neighbors % ",".join(["?"] * len(chunk))
+                    for other, node_id, distance in c.execute(q, chunk):
+                        bound = changed[node_id] + 1
+                        if (distance is None or distance > bound) and \
+                                closer.get(other, bound + 1) > bound:
+                            closer[other] = bound
+
+    def get_end_distance(self, node_id, direction):
+        """Return the number of edges between node_id and the end
+        context, following edges (direction=1) or against them
+        (direction=0). None means it can't reach the end context."""
+        entry = self._end_distance_cache.get(node_id)
+        if entry is None:
+            q = "SELECT forward, backward FROM node_distances WHERE id = ?"
+            row = self._conn.execute(q, (node_id,)).fetchone()
+            entry = tuple(row) if row else (None, None)
+            self._end_distance_cache.put(node_id, entry)
+
+        if direction:
+            return entry[0]
+        return entry[1]
+
+    def _end_budget(self, max_len, length):
+        # The furthest from the end context a walk that has used
+        # length of max_len characters can step. Every edge but the
+        # last one of a reply adds at least a character.
+        if max_len is not None:
+            return max_len - length + 1
+
+    def reachable_edges(self, rows, direction, max_len=None, length=0):
+        """Filter get_adjacent rows down to the edges whose other node
+        can reach the end context, within max_len characters if it's
+        set and length have been used."""
+        budget = self._end_budget(max_len, length)
+
+        reachable = []
+        for row in rows:
+            distance = self.get_end_distance(row[1], direction)
+            if distance is not None and (budget is None or
+                                         distance <= budget):
+                reachable.append(row)
+
+        return reachable
+
     def _maybe_create_node_count_triggers(self):
         # Create triggers on the edges table to update nodes counts.
         # In previous versions, the node counts were updated with a
@@ -0,0 +1,69 @@
+# Copyright (C) 2014 Peter Teichman
+
+import collections
+
+
+class LRUCache:
+    """A size-bounded mapping that evicts its least recently used
+entries once the total size of its values exceeds maxsize.
+
+By default every value has size 1, so maxsize is an entry count. Pass
+a sizeof function to weigh entries differently (e.g. by the length of
+a cached list). If on_evict is set, it is called as on_evict(key,
+value) for each entry dropped to make room."""
+    def __init__(self, maxsize, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.size = 0
+
+        self._sizeof = sizeof
+        self._on_evict = on_evict
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+
+        self._data[key] = value
+        self.size += self._entry_size(value)
+
+        while self.size > self.maxsize and len(self._data) > 1:
+            old_key, old_value = self._data.popitem(last=False)
+            self.size -= self._entry_size(old_value)
+
+            if self._on_evict is not None:
+                self._on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+
+        value = self._data.pop(key)
+        self.size -= self._entry_size(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def _entry_size(self, value):
+        if self._sizeof is None:
+            return 1
+
+        return self._sizeof(value)
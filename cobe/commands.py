@@ -1,16 +1,14 @@
 # Copyright (C) 2014 Peter Teichman
 
+import argparse
 import atexit
 import logging
 import os
 import re
-import readline
-import Stemmer
 import sys
-import time
 
-from .bot import Runner
 from .brain import Brain
+from .dedup import Deduplicator
 
 log = logging.getLogger("cobe")
 
@@ -24,6 +22,8 @@ class InitCommand:
         subparser.add_argument("--order", type=int, default=3)
         subparser.add_argument("--megahal", action="store_true",
                                help="Use MegaHAL-compatible tokenizer")
+        subparser.add_argument("--packed-keys", action="store_true",
+                               help="Index nodes by a single packed key")
         subparser.set_defaults(run=cls.run)
 
     @staticmethod
@@ -41,7 +41,29 @@ class InitCommand:
         if args.megahal:
             tokenizer = "MegaHAL"
 
-        Brain.init(filename, order=args.order, tokenizer=tokenizer)
+        Brain.init(filename, order=args.order, tokenizer=tokenizer,
+                   packed_keys=args.packed_keys)
+
+
+class UpgradeCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser("upgrade",
+                                      help="Upgrade a brain to the current "
+                                      "schema")
+        subparser.add_argument("--packed-keys", action="store_true",
+                               help="Switch to packed node keys")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def run(args):
+        filename = args.brain
+
+        if not os.path.exists(filename):
+            log.error("%s does not exist!", filename)
+            return
+
+        Brain.upgrade(filename, packed_keys=args.packed_keys)
 
 
 def progress_generator(filename):
@@ -63,40 +85,76 @@ def progress_generator(filename):
     fd.close()
 
 
+class FileProgress:
+    """Iterates over the lines of a file (see progress_generator),
+    keeping track of how far through it is, to show the progress of
+    Brain.learn_many."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.percent = 0.
+
+    def __iter__(self):
+        for line, percent in progress_generator(self.filename):
+            self.percent = percent
+            yield line
+
+    def show(self, status):
+        sys.stdout.write("\r%.0f%% (%d/s)" % (self.percent,
+                                              status.lines_per_sec))
+        sys.stdout.flush()
+
+    @staticmethod
+    def done(status):
+        if status.duplicates:
+            print("\r100%% (%d/s, %d duplicates skipped)"
+                  % (status.lines_per_sec, status.duplicates))
+        else:
+            print("\r100%% (%d/s)" % status.lines_per_sec)
+
+
+def add_dedup_arguments(subparser):
+    subparser.add_argument("--dedup", action="store_true",
+                           help="Skip lines that were already learned")
+    subparser.add_argument("--max-repeats", type=int,
+                           help="Learn at most this many copies of a line "
+                           "per --repeat-window lines")
+    subparser.add_argument("--repeat-window", type=int, default=10000,
+                           help="Lines per window for --max-repeats")
+
+
+def make_deduplicator(args):
+    if args.max_repeats is not None:
+        return Deduplicator(max_repeats=args.max_repeats,
+                            window=args.repeat_window)
+    elif args.dedup:
+        return Deduplicator()
+
+
 class LearnCommand:
     @classmethod
     def add_subparser(cls, parser):
         subparser = parser.add_parser("learn", help="Learn a file of text")
+        add_dedup_arguments(subparser)
         subparser.add_argument("file", nargs="+")
         subparser.set_defaults(run=cls.run)
 
     @staticmethod
     def run(args):
         b = Brain(args.brain)
-        b.start_batch_learning()
 
-        for filename in args.file:
-            now = time.time()
-            print(filename)
-
-            count = 0
-            for line, progress in progress_generator(filename):
-                show_progress = ((count % 1000) == 0)
+        size = sum([os.path.getsize(filename) for filename in args.file])
+        b.start_batch_learning(size_hint=size)
 
-                if show_progress:
-                    elapsed = time.time() - now
-                    sys.stdout.write("\r%.0f%% (%d/s)" % (progress,
-                                                          count / elapsed))
-                    sys.stdout.flush()
+        dedup = make_deduplicator(args)
 
-                b.learn(line.strip())
-                count = count + 1
+        for filename in args.file:
+            print(filename)
 
-                if (count % 10000) == 0:
-                    b.graph.commit()
+            progress = FileProgress(filename)
+            lines = (line.strip() for line in progress)
 
-            elapsed = time.time() - now
-            print("\r100%% (%d/s)" % (count / elapsed))
+            status = b.learn_many(lines, progress=progress.show, dedup=dedup)
+            FileProgress.done(status)
 
         b.stop_batch_learning()
 
@@ -115,49 +173,45 @@ class LearnIrcLogCommand:
         subparser.add_argument("-r", "--reply-to", action="append",
                                help="Reply (invisibly) to things said "
                                "to specified nick")
+        add_dedup_arguments(subparser)
         subparser.add_argument("file", nargs="+")
         subparser.set_defaults(run=cls.run)
 
     @classmethod
     def run(cls, args):
         b = Brain(args.brain)
-        b.start_batch_learning()
 
-        for filename in args.file:
-            now = time.time()
-            print(filename)
-
-            count = 0
-            for line, progress in progress_generator(filename):
-                show_progress = ((count % 100) == 0)
+        size = sum([os.path.getsize(filename) for filename in args.file])
+        b.start_batch_learning(size_hint=size)
 
-                if show_progress:
-                    elapsed = time.time() - now
-                    sys.stdout.write("\r%.0f%% (%d/s)" % (progress,
-                                                          count / elapsed))
-                    sys.stdout.flush()
+        dedup = make_deduplicator(args)
 
-                count = count + 1
+        for filename in args.file:
+            print(filename)
 
-                if (count % 1000) == 0:
-                    b.graph.commit()
+            progress = FileProgress(filename)
+            messages = cls._messages(b, progress, args)
 
-                parsed = cls._parse_irc_message(line.strip(),
-                                                args.ignored_nicks,
-                                                args.only_nicks)
-                if parsed is None:
-                    continue
+            status = b.learn_many(messages, progress=progress.show,
+                                  progress_every=100, dedup=dedup)
+            FileProgress.done(status)
 
-                to, msg = parsed
-                b.learn(msg)
+        b.stop_batch_learning()
 
-                if args.reply_to is not None and to in args.reply_to:
-                    b.reply(msg)
+    @classmethod
+    def _messages(cls, brain, lines, args):
+        for line in lines:
+            parsed = cls._parse_irc_message(line.strip(),
+                                            args.ignored_nicks,
+                                            args.only_nicks)
+            if parsed is None:
+                continue
 
-            elapsed = time.time() - now
-            print("\r100%% (%d/s)" % (count / elapsed))
+            to, msg = parsed
+            yield msg
 
-        b.stop_batch_learning()
+            if args.reply_to is not None and to in args.reply_to:
+                brain.reply(msg)
 
     @staticmethod
     def _parse_irc_message(msg, ignored_nicks=None, only_nicks=None):
@@ -190,6 +244,106 @@ class LearnIrcLogCommand:
         return to, msg
 
 
+class CompileCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser("compile",
+                                      help="Write a read-only, "
+                                      "memory-mappable copy of the brain")
+        subparser.add_argument("output")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def run(args):
+        b = Brain(args.brain)
+
+        b.compile(args.output)
+
+
+class MergeCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser("merge",
+                                      help="Merge other brains into this one")
+        subparser.add_argument("file", nargs="+")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def run(args):
+        seen = {os.path.realpath(args.brain): args.brain}
+        for filename in args.file:
+            path = os.path.realpath(filename)
+            if path in seen:
+                log.error("%s is the same brain as %s", filename, seen[path])
+                return
+
+            seen[path] = filename
+
+        stemmer = None
+        if not os.path.exists(args.brain):
+            # create a brain with the same settings as the first input
+            first = Brain(args.file[0], readonly=True)
+            graph = first.graph
+
+            Brain.init(args.brain, order=first.order,
+                       tokenizer=graph.get_info_text("tokenizer"),
+                       packed_keys=graph.packed_keys)
+
+            stemmer = graph.get_info_text("stemmer")
+            graph.close()
+
+        b = Brain(args.brain)
+        if stemmer is not None:
+            b.set_stemmer(stemmer)
+
+        for filename in args.file:
+            print(filename)
+            b.merge(filename)
+
+
+class PruneCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser("prune",
+                                      help="Remove rarely used edges")
+        subparser.add_argument("-c", "--min-count", type=int, default=2,
+                               help="Keep edges seen at least this often")
+        subparser.add_argument("--batch-size", type=int, default=10000,
+                               help="Rows to process per transaction")
+        subparser.add_argument("--vacuum", action="store_true",
+                               help="Compact the brain file afterwards")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def run(args):
+        b = Brain(args.brain)
+
+        b.prune(min_count=args.min_count, batch_size=args.batch_size,
+                vacuum=args.vacuum)
+
+
+class DistancesCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser(
+            "distances", help="Compute each node's distance to a reply end")
+        subparser.add_argument("--drop", action="store_true",
+                               help="Remove the distances instead")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def run(args):
+        b = Brain(args.brain)
+
+        if args.drop:
+            b.drop_end_distances()
+            return
+
+        forward, backward = b.update_end_distances()
+        print("%d nodes reach the end forward, %d backward" %
+              (forward, backward))
+
+
 class ConsoleCommand:
     @classmethod
     def add_subparser(cls, parser):
@@ -198,6 +352,8 @@ class ConsoleCommand:
 
     @staticmethod
     def run(args):
+        import readline
+
         b = Brain(args.brain)
 
         history = os.path.expanduser("~/.cobe_history")
@@ -218,6 +374,55 @@ class ConsoleCommand:
             print(b.reply(cmd).encode("utf-8"))
 
 
+class ReplyCommand:
+    @classmethod
+    def add_subparser(cls, parser):
+        subparser = parser.add_parser("reply",
+                                      help="Reply to each line of a file")
+        subparser.add_argument("file", nargs="*",
+                               help="Files of prompts (default: stdin)")
+        subparser.add_argument("--loop-ms", type=int, default=500,
+                               help="Time to spend on each reply")
+        subparser.add_argument("--max-len", type=int,
+                               help="Maximum reply length in characters")
+        subparser.add_argument("--max-candidates", type=int,
+                               help="Maximum candidates scored per reply")
+        subparser.add_argument("-j", "--processes", type=int,
+                               help="Reply from this many processes")
+        subparser.add_argument("--engine", choices=Brain.ENGINES,
+                               default="random",
+                               help="Reply candidate generator")
+        subparser.add_argument("--pivot-policy", choices=Brain.PIVOT_POLICIES,
+                               default="uniform",
+                               help="How to weigh the words of a prompt")
+        subparser.set_defaults(run=cls.run)
+
+    @staticmethod
+    def _prompts(filenames):
+        if not filenames:
+            for line in sys.stdin:
+                yield line.rstrip("\r\n")
+            return
+
+        for filename in filenames:
+            for line, progress in progress_generator(filename):
+                yield line.rstrip("\r\n")
+
+    @classmethod
+    def run(cls, args):
+        b = Brain(args.brain, readonly=True, engine=args.engine,
+                  pivot_policy=args.pivot_policy)
+
+        replies = b.reply_many(cls._prompts(args.file), loop_ms=args.loop_ms,
+                               max_len=args.max_len,
+                               max_candidates=args.max_candidates,
+                               processes=args.processes)
+
+        for reply in replies:
+            sys.stdout.write(reply + "\n")
+            sys.stdout.flush()
+
+
 class IrcClientCommand:
     @classmethod
     def add_subparser(cls, parser):
@@ -239,16 +444,49 @@ class IrcClientCommand:
         subparser.add_argument("-o", "--only-nick", action="append",
                                dest="only_nicks",
                                help="Only learn from a specific IRC nick")
+        subparser.add_argument("--fragment-cache", type=int,
+                               help="Keep reply fragments for this many "
+                               "nodes between replies")
+        subparser.add_argument("--refill-interval", type=float,
+                               help="Seconds between idle fragment cache "
+                               "refills")
+        subparser.add_argument("--pivot-policy", choices=Brain.PIVOT_POLICIES,
+                               default="uniform",
+                               help="How to weigh the words of a message")
+        subparser.add_argument("--reply-cache", type=int,
+                               help="Keep replies to this many recent "
+                               "messages")
+        subparser.add_argument("--reply-cache-ttl", type=float,
+                               help="Seconds to keep cached replies")
 
         subparser.set_defaults(run=cls.run)
 
     @staticmethod
     def run(args):
-        b = Brain(args.brain)
+        # twisted and irc are only needed by this command
+        from .bot import Runner
+
+        b = Brain(args.brain, fragment_cache_size=args.fragment_cache,
+                  pivot_policy=args.pivot_policy,
+                  reply_cache_size=args.reply_cache,
+                  reply_cache_ttl=args.reply_cache_ttl)
 
         Runner().run(b, args)
 
 
+def stemmer_language(name):
+    # Validate the language when it's parsed, so PyStemmer is only
+    # imported by the set-stemmer command.
+    import Stemmer
+
+    if name not in Stemmer.algorithms():
+        raise argparse.ArgumentTypeError(
+            "invalid choice: %r (choose from %s)" %
+            (name, ", ".join(sorted(Stemmer.algorithms()))))
+
+    return name
+
+
 class SetStemmerCommand:
     @classmethod
     def add_subparser(cls, parser):
@@ -257,7 +495,7 @@ class SetStemmerCommand:
 
         subparser.set_defaults(run=cls.run)
 
-        subparser.add_argument("language", choices=Stemmer.algorithms(),
+        subparser.add_argument("language", type=stemmer_language,
                                help="Stemmer language")
 
     @staticmethod
@@ -0,0 +1,585 @@
+# Copyright (C) 2014 Peter Teichman
+
+"""A read-only, memory-mappable brain format.
+
+compile_graph() writes a brain's graph into a single file of flat
+arrays. CompiledGraph maps that file and answers the queries needed to
+reply without touching SQLite. Every process serving the same file
+shares its pages through the OS page cache.
+
+Tokens, nodes and edges are renumbered from 1. Nodes are sorted by
+their token ids, so the nodes starting with a token are a contiguous
+range, and edges are sorted by (prev_node, next_node, has_space), so
+each node's outgoing edges are a contiguous range (forward CSR). The
+incoming edges of each node are listed in a second index (reverse
+CSR)."""
+
+import array
+import collections
+import itertools
+import json
+import math
+import mmap
+import random
+import struct
+import sys
+
+from .instatrace import trace_ms
+
+MAGIC = b"COBEMMAP"
+FORMAT_VERSION = 1
+
+# (name, array typecode) of each section, in file order. Typecode "B"
+# sections hold raw bytes.
+SECTIONS = [
+    ("info", "B"),
+    ("token_offsets", "q"),
+    ("token_text", "B"),
+    ("token_is_word", "B"),
+    ("token_sorted", "i"),
+    ("token_nodes", "q"),
+    ("node_tokens", "i"),
+    ("node_counts", "q"),
+    ("fwd_offsets", "q"),
+    ("edge_prev", "i"),
+    ("edge_next", "i"),
+    ("edge_counts", "q"),
+    ("edge_space", "B"),
+    ("rev_offsets", "q"),
+    ("rev_edges", "i"),
+    ("stem_offsets", "q"),
+    ("stem_text", "B"),
+    ("stem_token_offsets", "q"),
+    ("stem_tokens", "i"),
+]
+
+_HEADER = struct.Struct("<8sII")
+_SECTION = struct.Struct("<QQ")
+
+
+def is_compiled(filename):
+    """Return True if filename is a compiled brain."""
+    with open(filename, "rb") as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+
+# Number of values buffered before a section chunk is written out
+CHUNK_SIZE = 65536
+
+
+def _chunked(typecode, values):
+    # Pack an iterable of values into arrays of up to CHUNK_SIZE
+    chunk = array.array(typecode)
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = array.array(typecode)
+
+    if chunk:
+        yield chunk
+
+
+def _offsets(counts, start=0):
+    # Turn per-slot counts into CSR offsets: slot i spans
+    # [offsets[i], offsets[i + 1]).
+    total = start
+    yield total
+
+    for count in counts:
+        total += count
+        yield total
+
+
+def _dense_counts(rows, n):
+    # Expand (id, count) rows sorted by id into counts for ids 0..n
+    rows = iter(rows)
+    row = next(rows, None)
+
+    for i in range(n + 1):
+        if row is not None and row[0] == i:
+            yield row[1]
+            row = next(rows, None)
+        else:
+            yield 0
+
+
+def compile_graph(graph, filename):
+    """Compile a Graph into a memory-mappable brain file.
+
+    Nodes and edges are renumbered in temporary tables and streamed
+    out in their new order, so memory use doesn't grow with the size
+    of the brain. Only a map of token ids is kept in memory."""
+    c = graph.cursor()
+
+    if graph.readonly:
+        # temporary tables are still writable on a read-only brain
+        c.execute("PRAGMA query_only=0")
+
+    try:
+        with trace_ms("Compiled.compile_ms"):
+            _create_maps(graph)
+            _write_sections(filename, _sections(graph))
+    finally:
+        c.execute("DROP TABLE IF EXISTS temp.compiled_edges")
+        c.execute("DROP TABLE IF EXISTS temp.compiled_nodes")
+
+        if graph.readonly:
+            c.execute("PRAGMA query_only=1")
+
+
+def _create_maps(graph):
+    c = graph.cursor()
+
+    # compiled_nodes.id is the new id of each node, numbered in token
+    # order
+    c.execute("""
+CREATE TEMP TABLE compiled_nodes (
+    id INTEGER PRIMARY KEY,
+    old INTEGER NOT NULL)""")
+    c.execute("""
+INSERT INTO temp.compiled_nodes (old)
+    SELECT id FROM nodes ORDER BY %s""" % graph._node_order)
+    c.execute("""
+CREATE UNIQUE INDEX temp.compiled_nodes_old ON compiled_nodes (old)""")
+
+    # compiled_edges holds the renumbered edges, with ids in
+    # (prev, next, has_space) order
+    c.execute("""
+CREATE TEMP TABLE compiled_edges (
+    id INTEGER PRIMARY KEY,
+    prev INTEGER NOT NULL,
+    next INTEGER NOT NULL,
+    has_space INTEGER NOT NULL,
+    count INTEGER NOT NULL)""")
+    c.execute("""
+INSERT INTO temp.compiled_edges (prev, next, has_space, count)
+    SELECT p.id, n.id, edges.has_space, edges.count
+    FROM edges
+    JOIN temp.compiled_nodes AS p ON p.old = edges.prev_node
+    JOIN temp.compiled_nodes AS n ON n.old = edges.next_node
+    ORDER BY p.id, n.id, edges.has_space""")
+    c.execute("""
+CREATE INDEX temp.compiled_edges_next ON compiled_edges (next)""")
+
+
+def _sections(graph):
+    # Yield (name, chunks) for each section in file order, where
+    # chunks is an iterable of arrays or bytes.
+    c = graph.cursor()
+    order = graph.order
+
+    def column(q, typecode, args=()):
+        return _chunked(typecode, (row[0] for row in c.execute(q, args)))
+
+    info = dict(c.execute("SELECT attribute, text FROM info"))
+    info["byteorder"] = sys.byteorder
+    yield "info", [json.dumps(info).encode("utf-8")]
+
+    # Tokens keep their relative order, so the end token stays token 1
+    # and nodes sort the same on old and new token ids.
+    max_token = c.execute("SELECT coalesce(max(id), 0) FROM tokens")
+    token_map = array.array("i", [0]) * (max_token.fetchone()[0] + 1)
+    n_tokens = 0
+    for (token_id,) in c.execute("SELECT id FROM tokens ORDER BY id"):
+        n_tokens += 1
+        token_map[token_id] = n_tokens
+
+    def token_lengths():
+        yield 0
+        for (text,) in c.execute("SELECT text FROM tokens ORDER BY id"):
+            yield len(text.encode("utf-8"))
+
+    yield "token_offsets", _chunked("q", _offsets(token_lengths()))
+
+    def token_text():
+        for (text,) in c.execute("SELECT text FROM tokens ORDER BY id"):
+            yield text.encode("utf-8")
+
+    yield "token_text", token_text()
+
+    yield "token_is_word", itertools.chain(
+        [b"\0"], column("SELECT is_word != 0 FROM tokens ORDER BY id", "B"))
+
+    # BINARY collation compares the utf-8 bytes of each token
+    def token_sorted():
+        for (token_id,) in c.execute("SELECT id FROM tokens ORDER BY text"):
+            yield token_map[token_id]
+
+    yield "token_sorted", _chunked("i", token_sorted())
+
+    # token t starts the nodes numbered [token_nodes[t], token_nodes[t+1])
+    token_node_counts = c.execute("""
+SELECT %s AS token, count(*) FROM nodes GROUP BY token
+ORDER BY token""" % graph._node_tokens[0])
+    yield "token_nodes", _chunked("q", _offsets(
+        _dense_counts(((token_map[t], n) for t, n in token_node_counts),
+                      n_tokens), start=1))
+
+    node_q = """
+SELECT nodes.count, %s FROM temp.compiled_nodes AS n
+JOIN nodes ON nodes.id = n.old
+ORDER BY n.id""" % graph._all_tokens
+
+    def node_tokens():
+        yield from [0] * order
+        for row in c.execute(node_q):
+            for token_id in row[1:]:
+                yield token_map[token_id]
+
+    yield "node_tokens", _chunked("i", node_tokens())
+
+    yield "node_counts", itertools.chain(
+        [array.array("q", [0])], column(node_q, "q"))
+
+    n_nodes = c.execute("SELECT count(*) FROM temp.compiled_nodes")
+    n_nodes = n_nodes.fetchone()[0]
+
+    # Edge ids start at 1, so the forward offsets start there too
+    fwd_counts = c.execute("""
+SELECT prev, count(*) FROM temp.compiled_edges GROUP BY prev
+ORDER BY prev""")
+    yield "fwd_offsets", _chunked("q", _offsets(
+        _dense_counts(fwd_counts, n_nodes), start=1))
+
+    for name, col, typecode in [("edge_prev", "prev", "i"),
+                                ("edge_next", "next", "i"),
+                                ("edge_counts", "count", "q"),
+                                ("edge_space", "has_space != 0", "B")]:
+        q = "SELECT %s FROM temp.compiled_edges ORDER BY id" % col
+        yield name, itertools.chain([array.array(typecode, [0])],
+                                    column(q, typecode))
+
+    # Each node's incoming edges, sorted by id
+    rev_counts = c.execute("""
+SELECT next, count(*) FROM temp.compiled_edges GROUP BY next
+ORDER BY next""")
+    yield "rev_offsets", _chunked("q", _offsets(
+        _dense_counts(rev_counts, n_nodes)))
+
+    yield "rev_edges", column(
+        "SELECT id FROM temp.compiled_edges ORDER BY next, id", "i")
+
+    stem_q = "SELECT CAST(stem AS BLOB) AS stem, token_id FROM token_stems " \
+        "WHERE token_id IN (SELECT id FROM tokens) ORDER BY stem, token_id"
+
+    def stems():
+        # yield (stem, number of tokens) in stem order
+        last_stem, count = None, 0
+        for stem, token_id in c.execute(stem_q):
+            if stem != last_stem:
+                if last_stem is not None:
+                    yield last_stem, count
+
+                last_stem, count = stem, 0
+            count += 1
+
+        if last_stem is not None:
+            yield last_stem, count
+
+    yield "stem_offsets", _chunked("q", _offsets(
+        len(stem) for stem, count in stems()))
+    yield "stem_text", (bytes(stem) for stem, count in stems())
+    yield "stem_token_offsets", _chunked("q", _offsets(
+        count for stem, count in stems()))
+
+    def stem_tokens():
+        for stem, token_id in c.execute(stem_q):
+            yield token_map[token_id]
+
+    yield "stem_tokens", _chunked("i", stem_tokens())
+
+
+def _write_sections(filename, sections):
+    header_size = _HEADER.size + _SECTION.size * len(SECTIONS)
+
+    with open(filename, "wb") as fd:
+        fd.write(b"\0" * header_size)
+
+        table = []
+        for (name, typecode), (section, chunks) in zip(SECTIONS, sections):
+            assert name == section
+
+            # keep every section 8-byte aligned
+            pad = -fd.tell() % 8
+            fd.write(b"\0" * pad)
+
+            offset = fd.tell()
+            for chunk in chunks:
+                if isinstance(chunk, array.array):
+                    chunk = chunk.tobytes()
+
+                fd.write(chunk)
+
+            table.append((offset, fd.tell() - offset))
+
+        fd.seek(0)
+        fd.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(SECTIONS)))
+        for offset, length in table:
+            fd.write(_SECTION.pack(offset, length))
+
+
+class CompiledGraph:
+    """A read-only graph served from a compiled brain file. This
+implements the parts of the Graph interface used to reply."""
+
+    readonly = True
+
+    def __init__(self, filename):
+        self._fd = open(filename, "rb")
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+
+        magic, version, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or \
+                count != len(SECTIONS):
+            self.close()
+            raise ValueError("not a compiled cobe brain: %s" % filename)
+
+        view = memoryview(self._map)
+        self._views.append(view)
+
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = _SECTION.unpack_from(
+                self._map, _HEADER.size + i * _SECTION.size)
+
+            section = view[offset:offset + length]
+            if typecode != "B":
+                section = section.cast(typecode)
+
+            self._views.append(section)
+            setattr(self, "_" + name, section)
+
+        self._info = json.loads(bytes(self._info).decode("utf-8"))
+
+        if self._info.get("byteorder") != sys.byteorder:
+            self.close()
+            raise ValueError("compiled brain has the wrong byte order: %s"
+                             % filename)
+
+        self.order = int(self._info["order"])
+        self._n_tokens = len(self._token_offsets) - 2
+        self._n_nodes = len(self._node_counts) - 1
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+
+        self._map.close()
+        self._fd.close()
+
+    def commit(self):
+        pass
+
+    def total_changes(self):
+        return 0
+
+    def is_initted(self):
+        return True
+
+    def enable_stem_cache(self, maxsize):
+        # stems are always served from the mapping
+        pass
+
+    def enable_adjacency_cache(self, max_edges):
+        # adjacency is always served from the mapping
+        pass
+
+    def clear_caches(self):
+        pass
+
+    def get_info_text(self, attribute, default=None, text_factory=None):
+        return self._info.get(attribute, default)
+
+    def _token_bytes(self, token_id):
+        offsets = self._token_offsets
+        return bytes(self._token_text[offsets[token_id]:
+                                      offsets[token_id + 1]])
+
+    def _token_string(self, token_id):
+        return self._token_bytes(token_id).decode("utf-8")
+
+    def get_token_by_text(self, text, create=False, stemmer=None):
+        key = text.encode("utf-8")
+
+        sorted_ids = self._token_sorted
+        lo, hi = 0, len(sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._token_bytes(sorted_ids[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(sorted_ids) and self._token_bytes(sorted_ids[lo]) == key:
+            return sorted_ids[lo]
+
+    def _stem_bytes(self, i):
+        offsets = self._stem_offsets
+        return bytes(self._stem_text[offsets[i]:offsets[i + 1]])
+
+    def get_token_stem_id(self, stem):
+        key = stem.encode("utf-8")
+
+        n_stems = len(self._stem_offsets) - 1
+        lo, hi = 0, n_stems
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._stem_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < n_stems and self._stem_bytes(lo) == key:
+            token_offsets = self._stem_token_offsets
+            return list(self._stem_tokens[token_offsets[lo]:
+                                          token_offsets[lo + 1]])
+
+        return []
+
+    def _is_token(self, token_id):
+        return type(token_id) is int and 0 < token_id <= self._n_tokens
+
+    def get_word_tokens(self, token_ids):
+        return [token_id for token_id in token_ids
+                if self._is_token(token_id) and
+                self._token_is_word[token_id]]
+
+    def get_tokens(self, token_ids):
+        return [token_id for token_id in token_ids
+                if self._is_token(token_id)]
+
+    def _node_token_ids(self, node_id):
+        order = self.order
+        return tuple(self._node_tokens[node_id * order:
+                                       (node_id + 1) * order])
+
+    def get_node_by_tokens(self, tokens, create=False):
+        tokens = tuple(tokens)
+        if not self._is_token(tokens[0]):
+            return None
+
+        lo = self._token_nodes[tokens[0]]
+        hi = self._token_nodes[tokens[0] + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._node_token_ids(mid) < tokens:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo <= self._n_nodes and self._node_token_ids(lo) == tokens:
+            return lo
+
+    def get_text_by_edge(self, edge_id):
+        prev = self._edge_prev[edge_id]
+        token_id = self._node_tokens[prev * self.order + self.order - 1]
+
+        return self._token_string(token_id), self._edge_space[edge_id]
+
+    def has_end_distances(self):
+        return False
+
+    def get_edge_length(self, edge_id):
+        text, has_space = self.get_text_by_edge(edge_id)
+        return len(text) + has_space
+
+    def get_random_token(self):
+        # token 1 is the end token, as in Graph.get_random_token
+        if self._n_tokens >= 2:
+            return random.randint(2, self._n_tokens)
+
+    def get_token_node_count(self, token_id):
+        if not self._is_token(token_id):
+            return 0
+
+        return self._token_nodes[token_id + 1] - self._token_nodes[token_id]
+
+    def get_token_node(self, token_id, index):
+        if index < self.get_token_node_count(token_id):
+            return self._token_nodes[token_id] + index
+
+    def get_random_node_with_token(self, token_id):
+        if not self._is_token(token_id):
+            return None
+
+        lo = self._token_nodes[token_id]
+        hi = self._token_nodes[token_id + 1]
+        if lo < hi:
+            return random.randrange(lo, hi)
+
+    def get_edge_logprob(self, edge_id):
+        edge_count = self._edge_counts[edge_id]
+        node_count = self._node_counts[self._edge_prev[edge_id]]
+
+        return math.log(edge_count, 2) - math.log(node_count, 2)
+
+    def has_space(self, edge_id):
+        return bool(self._edge_space[edge_id])
+
+    def _edges(self, node_id, direction):
+        # Return the ids of edges leaving node_id (direction=1) or
+        # arriving at it (direction=0), with the node at their other
+        # end.
+        if direction:
+            lo, hi = self._fwd_offsets[node_id], self._fwd_offsets[node_id + 1]
+            return range(lo, hi), self._edge_next
+
+        lo, hi = self._rev_offsets[node_id], self._rev_offsets[node_id + 1]
+        return self._rev_edges[lo:hi], self._edge_prev
+
+    def get_adjacent(self, node, direction):
+        """Return the edges leaving node (direction=1) or arriving at
+        it (direction=0), as (edge_id, other node, count, has_space)
+        tuples."""
+        edge_ids, others = self._edges(node, direction)
+
+        return [(edge_id, others[edge_id], self._edge_counts[edge_id],
+                 self._edge_space[edge_id]) for edge_id in edge_ids]
+
+    def get_adjacent_info(self, node, direction):
+        return [row + (self.get_edge_logprob(row[0]),
+                       self.get_edge_length(row[0]))
+                for row in self.get_adjacent(node, direction)]
+
+    def search_bfs(self, start_id, end_id, direction):
+        left = collections.deque([(start_id, tuple())])
+        while left:
+            cur, path = left.popleft()
+            edge_ids, others = self._edges(cur, direction)
+
+            for edge_id in edge_ids:
+                newpath = path + (edge_id,)
+                next = others[edge_id]
+
+                if next == end_id:
+                    yield newpath
+                else:
+                    left.append((next, newpath))
+
+    def search_random_walk(self, start_id, end_id, direction,
+                           max_len=None):
+        """Walk once randomly from start_id to end_id, giving up once
+        the walk's text is longer than max_len, if that's set."""
+        cur = start_id
+        path = tuple()
+        length = 0
+
+        while True:
+            edge_ids, others = self._edges(cur, direction)
+            if len(edge_ids) == 0:
+                return
+
+            edge_id = edge_ids[random.randrange(len(edge_ids))]
+            path = path + (edge_id,)
+            cur = others[edge_id]
+
+            if max_len is not None:
+                length += self.get_edge_length(edge_id)
+                if length > max_len:
+                    return
+
+            if cur == end_id:
+                yield path
+                return
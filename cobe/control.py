@@ -12,13 +12,19 @@ parser.add_argument("--instatrace", metavar="FILE",
                     help="log performance statistics to FILE")
 
 subparsers = parser.add_subparsers(title="Commands")
+commands.CompileCommand.add_subparser(subparsers)
 commands.ConsoleCommand.add_subparser(subparsers)
+commands.DistancesCommand.add_subparser(subparsers)
 commands.InitCommand.add_subparser(subparsers)
 commands.IrcClientCommand.add_subparser(subparsers)
 commands.LearnCommand.add_subparser(subparsers)
 commands.LearnIrcLogCommand.add_subparser(subparsers)
+commands.MergeCommand.add_subparser(subparsers)
+commands.PruneCommand.add_subparser(subparsers)
+commands.ReplyCommand.add_subparser(subparsers)
 commands.SetStemmerCommand.add_subparser(subparsers)
 commands.DelStemmerCommand.add_subparser(subparsers)
+commands.UpgradeCommand.add_subparser(subparsers)
 
 
 def main():
@@ -0,0 +1,117 @@
+# Copyright (C) 2014 Peter Teichman
+
+import collections
+import hashlib
+import math
+
+
+def normalize(text):
+    """Reduce a line to the form compared for duplicates: lowercased,
+with runs of whitespace collapsed to single spaces."""
+    return " ".join(text.lower().split())
+
+
+class BloomFilter:
+    """A fixed-size set of byte strings that may report false
+positives. It is sized to hold capacity keys with a false positive
+rate of error_rate, and never grows past that."""
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.count = 0
+
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: k positions from two 64 bit halves of a digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """Add key, returning True if it was (probably) present
+        already."""
+        bits = self._bits
+        present = True
+
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                present = False
+
+        if not present:
+            self.count += 1
+        return present
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
+
+
+class Deduplicator:
+    """Decides which lines of a learning stream are repeats to drop.
+
+With no window, each distinct line is allowed once: lines are
+remembered in a BloomFilter of the given capacity, which is emptied
+when it fills so memory stays fixed. A small fraction (error_rate) of
+new lines may be taken for repeats.
+
+With a window of N lines, at most max_repeats copies of a line are
+allowed per N lines seen; the counts are exact and kept for the
+current window only.
+
+Lines are compared after normalize(). The seen and dropped attributes
+count the lines checked and rejected so far."""
+    def __init__(self, max_repeats=1, window=None, capacity=1000000,
+                 error_rate=0.001):
+        if max_repeats < 1:
+            raise ValueError("max_repeats must be at least 1")
+
+        self.max_repeats = max_repeats
+        self.window = window
+
+        self.seen = 0
+        self.dropped = 0
+
+        if window is None:
+            if max_repeats != 1:
+                raise ValueError("max_repeats needs a window")
+            self._filter = BloomFilter(capacity, error_rate)
+        else:
+            self._counts = collections.Counter()
+
+    def allow(self, text):
+        """Return True if text should be learned."""
+        key = normalize(text).encode("utf-8")
+
+        if self.window is None:
+            bloom = self._filter
+            if bloom.count >= bloom.capacity:
+                bloom.clear()
+
+            duplicate = bloom.add(key)
+        else:
+            if self.seen % self.window == 0:
+                self._counts.clear()
+
+            key = hashlib.blake2b(key, digest_size=8).digest()
+            self._counts[key] += 1
+            duplicate = self._counts[key] > self.max_repeats
+
+        self.seen += 1
+        if duplicate:
+            self.dropped += 1
+        return not duplicate
@@ -20,6 +20,42 @@ class Scorer:
     def score(self, reply):
         return NotImplementedError
 
+    def fragment(self, graph, edge_ids):
+        """Return a partial score for a reply fragment. A reply made
+        of two fragments can be scored by passing both of their
+        partial scores to combine(), which gives the same score as
+        score(). Scorers that can't be split this way return None."""
+        return None
+
+    def combine(self, graph, prev, next):
+        """Return the score of a reply made of two fragments, from
+        their partial scores (see fragment)."""
+        return None
+
+    def _information(self, graph, edge_ids):
+        # The information content of edge_ids, with the logprobs it
+        # was summed from, so the sum can be carried on over another
+        # fragment's edges in the same order as score() adds them.
+        logprob_cache = self.cache.setdefault("logprob", {})
+
+        get_edge_logprob = graph.get_edge_logprob
+
+        logprobs = []
+        for edge_id in edge_ids:
+            if edge_id not in logprob_cache:
+                logprob_cache[edge_id] = get_edge_logprob(edge_id)
+
+            logprobs.append(logprob_cache[edge_id])
+
+        return _sum_information(0., logprobs), tuple(logprobs)
+
+
+def _sum_information(info, logprobs):
+    for logprob in logprobs:
+        info -= logprob
+
+    return info
+
 
 class ScorerGroup:
     def __init__(self):
@@ -55,41 +91,71 @@ class ScorerGroup:
 
         return score / self.total_weight
 
+    def fragment(self, graph, edge_ids):
+        partials = []
+        for weight, scorer in self.scorers:
+            partial = scorer.fragment(graph, edge_ids)
+            if partial is None:
+                return None
+
+            partials.append(partial)
+
+        return tuple(partials)
+
+    def combine(self, graph, prev, next):
+        # the same sum as score(), from each scorer's partial scores
+        score = 0.
+        for (weight, scorer), p, n in zip(self.scorers, prev, next):
+            s = scorer.combine(graph, p, n)
+
+            if weight < 0.0:
+                s = 1.0 - s
+
+            score += abs(weight) * s
+
+        return score / self.total_weight
+
 
 class CobeScorer(Scorer):
     """Classic Cobe scorer"""
     def score(self, reply):
-        edge_ids = reply.edge_ids
-        info = 0.
-
-        logprob_cache = self.cache.setdefault("logprob", {})
+        info, _, n_edges, n_spaces = self.fragment(reply.graph,
+                                                   reply.edge_ids)
+        return self._score(reply.graph, info, n_edges, n_spaces)
+
+    def fragment(self, graph, edge_ids):
+        # The partial score is the fragment's information content and
+        # logprobs, number of edges, and number of edges followed by a
+        # space.
         space_cache = self.cache.setdefault("has_space", {})
+        has_space = graph.has_space
 
-        get_edge_logprob = reply.graph.get_edge_logprob
-        has_space = reply.graph.has_space
-
-        # Calculate the information content of the edges in this reply.
+        n_spaces = 0
         for edge_id in edge_ids:
-            if edge_id not in logprob_cache:
-                logprob_cache[edge_id] = get_edge_logprob(edge_id)
+            if edge_id not in space_cache:
+                space_cache[edge_id] = has_space(edge_id)
 
-            info -= logprob_cache[edge_id]
+            if space_cache[edge_id]:
+                n_spaces += 1
+
+        info, logprobs = self._information(graph, edge_ids)
+        return info, logprobs, len(edge_ids), n_spaces
+
+    def combine(self, graph, prev, next):
+        return self._score(graph, _sum_information(prev[0], next[1]),
+                           prev[2] + next[2], prev[3] + next[3])
 
+    def _score(self, graph, info, n_edges, n_spaces):
         # Approximate the number of cobe 1.2 contexts in this reply, so the
         # scorer will have similar results.
 
         # First, we have (graph.order - 1) extra edges on either end of the
         # reply, since cobe 2.0 learns from (_END_TOKEN, _END_TOKEN, ...).
-        n_words = len(edge_ids) - (reply.graph.order - 1) * 2
+        n_words = n_edges - (graph.order - 1) * 2
 
         # Add back one word for each space between edges, since cobe 1.2
         # treated those as separate parts of a context.
-        for edge_id in edge_ids:
-            if edge_id not in space_cache:
-                space_cache[edge_id] = has_space(edge_id)
-
-            if space_cache[edge_id]:
-                n_words += 1
+        n_words += n_spaces
 
         # Double the score, since Cobe 1.x scored both forward and backward
         info *= 2.0
@@ -112,23 +178,22 @@ class CobeScorer(Scorer):
 class InformationScorer(Scorer):
     """Score based on the information of each edge in the graph"""
     def score(self, reply):
-        edge_ids = reply.edge_ids
-        info = 0.
-
-        logprob_cache = self.cache.setdefault("logprob", {})
-
-        get_edge_logprob = reply.graph.get_edge_logprob
-
-        # Calculate the information content of the edges in this reply.
-        for edge_id in edge_ids:
-            if edge_id not in logprob_cache:
-                logprob_cache[edge_id] = get_edge_logprob(edge_id)
+        return self.normalize(
+            self._information(reply.graph, reply.edge_ids)[0])
 
-            info -= logprob_cache[edge_id]
+    def fragment(self, graph, edge_ids):
+        return self._information(graph, edge_ids)
 
-        return self.normalize(info)
+    def combine(self, graph, prev, next):
+        return self.normalize(_sum_information(prev[0], next[1]))
 
 
 class LengthScorer(Scorer):
     def score(self, reply):
         return self.normalize(len(reply.edge_ids))
+
+    def fragment(self, graph, edge_ids):
+        return len(edge_ids)
+
+    def combine(self, graph, prev, next):
+        return self.normalize(prev + next)
@@ -1,7 +1,6 @@
 # Copyright (C) 2010 Peter Teichman
 
 import re
-import Stemmer
 
 
 class MegaHALTokenizer:
@@ -105,7 +104,10 @@ tokens."""
 
 class CobeStemmer:
     def __init__(self, name):
-        # use the PyStemmer Snowball stemmer bindings
+        # use the PyStemmer Snowball stemmer bindings, imported here
+        # so brains without a stemmer don't pay for loading them
+        import Stemmer
+
         self.stemmer = Stemmer.Stemmer(name)
 
     def stem(self, token):
@@ -1,11 +1,25 @@
-from cobe.brain import Brain, CobeError
+from cobe.brain import Brain, CobeError, Reply, _FragmentStore
+from cobe.brain import pack_node_key, unpack_node_key
+from cobe.dedup import Deduplicator
 from cobe.tokenizers import MegaHALTokenizer
+import array
+import collections
+import glob
 import pickle as pickle
 import os
+import sqlite3
+import time
 import unittest
 
 TEST_BRAIN_FILE = "test_cobe.brain"
 
+
+def tearDownModule():
+    # remove test brains along with any journals left by brains that
+    # were never closed
+    for filename in glob.glob("test_cobe*.brain*"):
+        os.remove(filename)
+
 class testInit(unittest.TestCase):
     def setUp(self):
         if os.path.exists(TEST_BRAIN_FILE):
@@ -21,6 +35,22 @@ class testInit(unittest.TestCase):
         self.assertTrue(brain._end_token_id,
                         "missing brain _end_token_id after init")
 
+    def testOpenWithoutWrites(self):
+        Brain.init(TEST_BRAIN_FILE)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        self.assertEqual(0, brain.graph._conn.total_changes)
+        self.assertTrue(brain._end_context_id)
+
+        # migrations are skipped once they have been stamped
+        c = brain.graph.cursor()
+        c.execute("DROP TRIGGER edges_insert_trigger")
+        brain.graph.commit()
+
+        brain = Brain(TEST_BRAIN_FILE)
+        q = "SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"
+        self.assertEqual(2, c.execute(q).fetchone()[0])
+
     def testInitWithOrder(self):
         order = 2
         Brain.init(TEST_BRAIN_FILE, order=order)
@@ -32,7 +62,7 @@ class testInit(unittest.TestCase):
         Brain.init(TEST_BRAIN_FILE)
 
         brain = Brain(TEST_BRAIN_FILE)
-        self.assertEqual("2", brain.graph.get_info_text("version"))
+        self.assertEqual("3", brain.graph.get_info_text("version"))
 
     def testEmptyReply(self):
         Brain.init(TEST_BRAIN_FILE)
@@ -56,6 +86,120 @@ class testInit(unittest.TestCase):
         else:
             self.fail("opened a wrong version brain file")
 
+    def testUpgrade(self):
+        # build a version 2 brain by hand
+        conn = sqlite3.connect(TEST_BRAIN_FILE)
+        conn.executescript("""
+CREATE TABLE info (attribute TEXT NOT NULL PRIMARY KEY, text TEXT NOT NULL);
+CREATE TABLE tokens (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT UNIQUE NOT NULL, is_word INTEGER NOT NULL);
+CREATE TABLE token_stems (token_id INTEGER, stem TEXT NOT NULL);
+CREATE TABLE nodes (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    count INTEGER NOT NULL, token0_id INTEGER, token1_id INTEGER);
+CREATE TABLE edges (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prev_node INTEGER NOT NULL, next_node INTEGER NOT NULL,
+    count INTEGER NOT NULL, has_space INTEGER NOT NULL);
+CREATE UNIQUE INDEX edges_all_prev ON edges
+    (prev_node, next_node, has_space, count);
+INSERT INTO info VALUES ('order', '2');
+INSERT INTO info VALUES ('tokenizer', 'Cobe');
+INSERT INTO info VALUES ('version', '2');
+INSERT INTO tokens (text, is_word) VALUES ('', 0), ('hello', 1);
+INSERT INTO nodes (count, token0_id, token1_id)
+    VALUES (1, 1, 1), (1, 1, 2), (1, 2, 1);
+INSERT INTO edges (prev_node, next_node, count, has_space)
+    VALUES (1, 2, 1, 0), (2, 3, 1, 0), (3, 1, 1, 0);
+""")
+        conn.commit()
+        conn.close()
+
+        try:
+            Brain(TEST_BRAIN_FILE)
+        except CobeError as e:
+            self.assertTrue("cobe upgrade" in str(e))
+        else:
+            self.fail("opened a version 2 brain file")
+
+        # refusing the brain left it untouched
+        conn = sqlite3.connect(TEST_BRAIN_FILE)
+        q = "SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"
+        self.assertEqual(0, conn.execute(q).fetchone()[0])
+        q = "SELECT count(*) FROM info WHERE attribute = 'migrations'"
+        self.assertEqual(0, conn.execute(q).fetchone()[0])
+        conn.close()
+
+        Brain.upgrade(TEST_BRAIN_FILE)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        self.assertEqual("3", brain.graph.get_info_text("version"))
+        self.assertEqual("hello", brain.reply("hello"))
+
+        # learning continues from the existing ids
+        brain.learn("hello there, world")
+        c = brain.graph.cursor()
+        self.assertEqual(1, c.execute("SELECT count(*) FROM edges "
+                                      "WHERE id = 4").fetchone()[0])
+
+    def testPackedKeys(self):
+        Brain.init(TEST_BRAIN_FILE, order=4, packed_keys=True)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        self.assertTrue(brain.graph.packed_keys)
+
+        brain.learn("this is a test of packed keys")
+        brain.learn("this is a test of packed keys")
+        self.assertEqual("this is a test of packed keys",
+                         brain.reply("packed", loop_ms=10))
+
+        c = brain.graph.cursor()
+        counts = c.execute("SELECT DISTINCT count FROM edges").fetchall()
+        self.assertEqual([(2,)], [tuple(row) for row in counts])
+
+        q = "SELECT count(*) FROM sqlite_master WHERE name = ?"
+        self.assertEqual(1, c.execute(q, ("nodes_key",)).fetchone()[0])
+        self.assertEqual(0, c.execute(q, ("nodes_token_ids",)).fetchone()[0])
+
+        # only the key is stored
+        columns = [row[1] for row in c.execute("PRAGMA table_info(nodes)")]
+        self.assertEqual(["id", "count", "key"], columns)
+
+    def testPackNodeKey(self):
+        values = [0, 1, 240, 241, 2287, 2288, 67823, 67824, 2 ** 24,
+                  2 ** 31, 2 ** 40]
+
+        for v in values:
+            self.assertEqual((v, 7), unpack_node_key(pack_node_key(v, 7)))
+
+        # keys sort like their token id tuples
+        tuples = sorted((a, b) for a in values for b in values[:4])
+        keys = [pack_node_key(*t) for t in tuples]
+        self.assertEqual(keys, sorted(keys))
+
+        self.assertEqual(4, len(pack_node_key(1, 200, 2000)))
+
+    def testUpgradePackedKeys(self):
+        Brain.init(TEST_BRAIN_FILE, order=3)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.learn("this is a test of packed keys")
+        brain.graph.close()
+
+        Brain.upgrade(TEST_BRAIN_FILE, packed_keys=True)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        self.assertTrue(brain.graph.packed_keys)
+
+        brain.learn("this is a test of packed keys")
+        c = brain.graph.cursor()
+        counts = c.execute("SELECT DISTINCT count FROM edges").fetchall()
+        self.assertEqual([(2,)], [tuple(row) for row in counts])
+
+        # node counts are still maintained by the triggers
+        q = "SELECT count(*) FROM nodes WHERE count != " \
+            "(SELECT coalesce(sum(count), 0) FROM edges " \
+            " WHERE next_node = nodes.id)"
+        self.assertEqual(0, c.execute(q).fetchone()[0])
+
     def testInitWithTokenizer(self):
         tokenizer = "MegaHAL"
         Brain.init(TEST_BRAIN_FILE, order=2, tokenizer=tokenizer)
@@ -128,6 +272,10 @@ class testLearn(unittest.TestCase):
                            (("test", 1), False),
                            ((1, 1), False)])
 
+        # any iterable will do
+        self.assertEqual(list(brain._to_edges(iter(tokens))),
+                         list(brain._to_edges(tokens)))
+
     def testExpandGraph(self):
         Brain.init(TEST_BRAIN_FILE, order=2)
         brain = Brain(TEST_BRAIN_FILE)
@@ -150,6 +298,249 @@ class testLearn(unittest.TestCase):
         brain.learn("this is a test")
         brain.learn("this is also a test")
 
+    def testLearnEdgeCounts(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.learn("this is a test")
+        brain.learn("this is a test")
+
+        c = brain.graph.cursor()
+        counts = c.execute("SELECT DISTINCT count FROM edges").fetchall()
+        self.assertEqual([(2,)], [tuple(row) for row in counts])
+
+        # each node count is the sum of its incoming edge counts
+        q = "SELECT count(*) FROM nodes WHERE count != " \
+            "(SELECT coalesce(sum(count), 0) FROM edges " \
+            " WHERE next_node = nodes.id)"
+        self.assertEqual(0, c.execute(q).fetchone()[0])
+
+    def testBatchLearnNodeCounts(self):
+        lines = ["this is a test", "this is another test",
+                 "this is a test", "another test entirely"]
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        for line in lines:
+            brain.learn(line)
+
+        q = "SELECT id, count FROM nodes ORDER BY id"
+        c = brain.graph.cursor()
+        expected = [tuple(row) for row in c.execute(q)]
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.learn(lines[0])
+        brain.start_batch_learning()
+        for line in lines[1:]:
+            brain.learn(line)
+        brain.stop_batch_learning()
+
+        c = brain.graph.cursor()
+        self.assertEqual(expected, [tuple(row) for row in c.execute(q)])
+
+        # triggers are back in place after the batch
+        q = "SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"
+        self.assertEqual(3, c.execute(q).fetchone()[0])
+
+    def testLearnMany(self):
+        lines = ["this is a test", "this is another test",
+                 "this is a test", "another test entirely", "too short",
+                 "a test, with punctuation!"]
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        for line in lines:
+            brain.learn(line)
+
+        c = brain.graph.cursor()
+        nodes_q = "SELECT id, count FROM nodes ORDER BY id"
+        edges_q = "SELECT prev_node, next_node, has_space, count " \
+            "FROM edges ORDER BY prev_node, next_node, has_space"
+        expected = ([tuple(row) for row in c.execute(nodes_q)],
+                    [tuple(row) for row in c.execute(edges_q)])
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.LEARN_BLOCK_SIZE = 4
+
+        # strings, bytes and token lists can be mixed
+        items = [lines[0], lines[1].encode("utf-8"),
+                 brain.tokenizer.split(lines[2])] + lines[3:]
+
+        reports = []
+        status = brain.learn_many(items, progress=reports.append,
+                                  progress_every=2)
+
+        c = brain.graph.cursor()
+        self.assertEqual(expected,
+                         ([tuple(row) for row in c.execute(nodes_q)],
+                          [tuple(row) for row in c.execute(edges_q)]))
+
+        self.assertEqual(6, status.lines)
+        self.assertEqual(sum(len(line) for line in lines),
+                         status.bytes)
+        self.assertEqual([4, 6, 6], [report.lines for report in reports])
+        self.assertFalse(brain._learning)
+
+    def testTokenIds(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.set_stemmer("english")
+
+        graph = brain.graph
+        known = graph.get_token_by_text("testing", create=True)
+
+        # new tokens get ids in the order they're first seen
+        token_ids = graph.get_token_ids(["zebra", "apple", "testing",
+                                         "mango", "apple", ","],
+                                        stemmer=brain.stemmer)
+        self.assertEqual(known, token_ids["testing"])
+        self.assertEqual([known + 1, known + 2, known + 3, known + 4],
+                         [token_ids[text] for text in
+                          ["zebra", "apple", "mango", ","]])
+
+        self.assertEqual(token_ids["zebra"],
+                         graph.get_token_by_text("zebra"))
+        self.assertEqual([token_ids["apple"]],
+                         graph.get_token_stem_id("appl"))
+
+        c = graph.cursor()
+        self.assertEqual([(1,), (0,)], [tuple(row) for row in c.execute(
+            "SELECT is_word FROM tokens WHERE id IN (?, ?) ORDER BY id",
+            (token_ids["mango"], token_ids[","]))])
+
+    def testLearnManyDedup(self):
+        edges_q = "SELECT prev_node, next_node, has_space, count " \
+            "FROM edges ORDER BY prev_node, next_node, has_space"
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+
+        c = brain.graph.cursor()
+        expected = [tuple(row) for row in c.execute(edges_q)]
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        items = ["this is a test", "This is a  test",
+                 brain.tokenizer.split("this is a test"),
+                 "this is another test"]
+
+        status = brain.learn_many(items, dedup=Deduplicator())
+        self.assertEqual(4, status.lines)
+        self.assertEqual(2, status.duplicates)
+
+        self.assertEqual(expected, [tuple(row) for row in
+                                    brain.graph.cursor().execute(edges_q)])
+
+    def testLearnLongLine(self):
+        # a line with more distinct edges than LEARN_MAX_EDGES is
+        # written in pieces, with the same result
+        text = " ".join("w%d" % (i % 50) for i in range(400))
+        edges_q = "SELECT prev_node, next_node, has_space, count " \
+            "FROM edges ORDER BY prev_node, next_node, has_space"
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.learn(text)
+
+        c = brain.graph.cursor()
+        expected = [tuple(row) for row in c.execute(edges_q)]
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.LEARN_MAX_EDGES = 7
+        brain.learn(text)
+
+        c = brain.graph.cursor()
+        self.assertEqual(expected, [tuple(row) for row in c.execute(edges_q)])
+
+    def testStagedBatchLearn(self):
+        lines = ["this is a test", "this is another test",
+                 "this is a test", "another test entirely"]
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+        for line in lines:
+            brain.learn(line)
+
+        q = "SELECT nodes.id, nodes.count, edges.next_node, edges.count " \
+            "FROM nodes, edges WHERE edges.prev_node = nodes.id " \
+            "ORDER BY nodes.id, edges.next_node"
+        c = brain.graph.cursor()
+        expected = [tuple(row) for row in c.execute(q)]
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.learn(lines[0])
+        brain.start_batch_learning(size_hint=10)
+        self.assertTrue(brain._staged)
+
+        brain.learn(lines[1])
+        brain.graph.commit()
+        for line in lines[2:]:
+            brain.learn(line)
+
+        # the reply index is kept while learning
+        q_index = "SELECT count(*) FROM sqlite_master " \
+            "WHERE name = 'edges_all_next'"
+        self.assertEqual(1, c.execute(q_index).fetchone()[0])
+
+        brain.stop_batch_learning()
+
+        c = brain.graph.cursor()
+        self.assertEqual(expected, [tuple(row) for row in c.execute(q)])
+
+    def testInterruptedBatchLearn(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.start_batch_learning()
+        brain.learn("this is a test")
+        brain.graph.commit()
+        brain.graph.close()
+
+        brain = Brain(TEST_BRAIN_FILE)
+        c = brain.graph.cursor()
+        q = "SELECT count(*) FROM nodes WHERE count != " \
+            "(SELECT coalesce(sum(count), 0) FROM edges " \
+            " WHERE next_node = nodes.id)"
+        self.assertEqual(0, c.execute(q).fetchone()[0])
+        self.assertEqual(None, brain.graph.get_info_text("node_counts"))
+
+        # the reverse walk index dropped for the batch is back
+        q = "SELECT count(*) FROM sqlite_master WHERE name = ?"
+        self.assertEqual(1, c.execute(q, ("edges_all_next",)).fetchone()[0])
+
+    def testBatchLearnInProgress(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.start_batch_learning()
+        brain.learn("this is a test")
+
+        # pretend a live process is running the batch
+        brain.graph.set_info_text("batch_pid", str(os.getppid()))
+        brain.graph.commit()
+
+        other = Brain(TEST_BRAIN_FILE)
+        self.assertEqual("stale", other.graph.get_info_text("node_counts"))
+        other.graph.close()
+
+        brain.stop_batch_learning()
+        self.assertEqual(None, brain.graph.get_info_text("node_counts"))
+        self.assertEqual(None, brain.graph.get_info_text("batch_pid"))
+
     def testLearnStems(self):
         Brain.init(TEST_BRAIN_FILE, order=2)
 
@@ -166,6 +557,612 @@ class testLearn(unittest.TestCase):
         self.assertEqual(brain.graph.get_token_stem_id(stem("test")),
                           brain.graph.get_token_stem_id(stem("testing")))
 
+    def testLearnStemsCached(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+
+        brain = Brain(TEST_BRAIN_FILE, stem_cache_size=100)
+        brain.set_stemmer("english")
+        stem = brain.stemmer.stem
+
+        brain.learn("this is testing")
+        test_ids = brain.graph.get_token_stem_id(stem("test"))
+        self.assertEqual(1, len(test_ids))
+
+        # a new token with a cached stem must be added to the cache
+        brain.learn("this is tested")
+        self.assertEqual(2, len(brain.graph.get_token_stem_id(stem("test"))))
+
+        brain.del_stemmer()
+        self.assertEqual([], brain.graph.get_token_stem_id(stem("test")))
+
+
+class testReadOnly(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.learn("this is a test")
+        brain.graph.close()
+
+    def testReadOnly(self):
+        for immutable in (False, True):
+            brain = Brain(TEST_BRAIN_FILE, readonly=True, immutable=immutable)
+
+            self.assertEqual("this is a test", brain.reply("test", loop_ms=10))
+            self.assertRaises(CobeError, brain.learn, "this is another test")
+            self.assertRaises(CobeError, brain.set_stemmer, "english")
+            self.assertEqual(0, brain.graph._conn.total_changes)
+
+            brain.graph.close()
+
+    def testMissing(self):
+        os.remove(TEST_BRAIN_FILE)
+
+        self.assertRaises(CobeError, Brain, TEST_BRAIN_FILE, readonly=True)
+        self.assertFalse(os.path.exists(TEST_BRAIN_FILE))
+
+
+class testInMemory(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+
+    def _edge_count(self):
+        brain = Brain(TEST_BRAIN_FILE, readonly=True)
+        c = brain.graph.cursor()
+        count = c.execute("SELECT count(*) FROM edges").fetchone()[0]
+        brain.graph.close()
+
+        return count
+
+    def testSave(self):
+        brain = Brain(TEST_BRAIN_FILE, in_memory=True)
+        brain.learn("this is a test")
+
+        self.assertEqual(0, self._edge_count())
+
+        brain.save()
+        self.assertEqual(6, self._edge_count())
+
+        brain.learn("this is another test")
+        brain.close()
+        self.assertEqual(9, self._edge_count())
+
+    def testSaveInterval(self):
+        brain = Brain(TEST_BRAIN_FILE, in_memory=True, save_interval=0.01)
+        brain.learn("this is a test")
+
+        for i in range(100):
+            if self._edge_count() == 6:
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("brain was not saved in the background")
+
+        brain.close()
+
+    def testNoSaveDuringBatchLearning(self):
+        brain = Brain(TEST_BRAIN_FILE, in_memory=True)
+
+        brain.start_batch_learning()
+        brain.learn("this is a test")
+        brain.save()
+
+        self.assertEqual(0, self._edge_count())
+
+        brain.stop_batch_learning()
+        brain.save()
+
+        self.assertEqual(6, self._edge_count())
+        brain.close()
+
+
+class testAdjacencyCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+
+    def testCachedLookups(self):
+        brain = Brain(TEST_BRAIN_FILE, adjacency_cache_size=1000)
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+
+        graph = brain.graph
+        c = graph.cursor()
+        rows = c.execute("SELECT id, prev_node, next_node FROM edges")
+        edges = [tuple(row) for row in rows]
+
+        uncached = Brain(TEST_BRAIN_FILE).graph
+        for edge_id, prev, next in edges:
+            self.assertEqual(uncached.get_adjacent(prev, 1),
+                             graph.get_adjacent(prev, 1))
+            self.assertEqual(uncached.get_adjacent(next, 0),
+                             graph.get_adjacent(next, 0))
+            self.assertEqual(uncached.get_edge_logprob(edge_id),
+                             graph.get_edge_logprob(edge_id))
+            self.assertEqual(uncached.has_space(edge_id),
+                             graph.has_space(edge_id))
+
+    def testLearnInvalidates(self):
+        brain = Brain(TEST_BRAIN_FILE, adjacency_cache_size=1000)
+        brain.learn("this is a test")
+
+        graph = brain.graph
+        this_id = graph.get_token_by_text("this")
+        node = graph.get_random_node_with_token(this_id)
+
+        self.assertEqual(1, len(graph.get_adjacent(node, 1)))
+
+        brain.learn("this is another test")
+        self.assertEqual(2, len(graph.get_adjacent(node, 1)))
+
+        edge_id = graph.get_adjacent(node, 1)[0][0]
+        self.assertEqual(-1.0, graph.get_edge_logprob(edge_id))
+
+    def testEviction(self):
+        brain = Brain(TEST_BRAIN_FILE, adjacency_cache_size=4)
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+
+        for i in range(10):
+            brain.reply("test", loop_ms=10)
+
+        graph = brain.graph
+        self.assertTrue(graph._adjacency_cache.size <= 4)
+        self.assertTrue(len(graph._adjacency_edges) <= 4)
+
+
+class testPrune(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        self._brain = Brain(TEST_BRAIN_FILE)
+
+    def testPrune(self):
+        brain = self._brain
+        brain.set_stemmer("english")
+
+        brain.learn("this is a test")
+        brain.learn("this is a test")
+        brain.learn("another sentence entirely")
+
+        edges, nodes, tokens = brain.prune(min_count=2, batch_size=2,
+                                           vacuum=True)
+        self.assertEqual(5, edges)
+        self.assertEqual(4, nodes)
+        self.assertEqual(3, tokens)
+
+        graph = brain.graph
+        self.assertEqual(None, graph.get_token_by_text("sentence"))
+        self.assertTrue(graph.get_token_by_text("test") is not None)
+        self.assertEqual([], graph.get_token_stem_id("sentenc"))
+
+        c = graph.cursor()
+        q = "SELECT count(*) FROM nodes WHERE count != " \
+            "(SELECT coalesce(sum(count), 0) FROM edges " \
+            " WHERE next_node = nodes.id)"
+        self.assertEqual(0, c.execute(q).fetchone()[0])
+
+        self.assertEqual("this is a test", brain.reply("test"))
+
+
+class testEndDistances(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        self._brain = Brain(TEST_BRAIN_FILE)
+
+    def _distances(self):
+        c = self._brain.graph.cursor()
+        return c.execute("SELECT id, forward, backward FROM node_distances "
+                         "ORDER BY id").fetchall()
+
+    def _node(self, *words):
+        graph = self._brain.graph
+        return graph.get_node_by_tokens(
+            [graph.get_token_by_text(word) for word in words])
+
+    def testDistances(self):
+        brain = self._brain
+        brain.learn("this is a test")
+        brain.learn("this is fun")
+
+        self.assertEqual((8, 8), brain.update_end_distances())
+
+        graph = brain.graph
+        self.assertEqual(0, graph.get_end_distance(brain._end_context_id, 1))
+        self.assertEqual(3, graph.get_end_distance(self._node("this", "is"),
+                                                   1))
+        self.assertEqual(2, graph.get_end_distance(self._node("is", "fun"),
+                                                   1))
+        self.assertEqual(3, graph.get_end_distance(self._node("is", "fun"),
+                                                   0))
+
+    def testLearnRelaxes(self):
+        brain = self._brain
+        brain.learn("this is a long test of the distances")
+        brain.update_end_distances()
+
+        brain.learn("this is short")
+        brain.learn("a test of them")
+        self.assertEqual(2, brain.graph.get_end_distance(
+            self._node("is", "short"), 1))
+
+        learned = self._distances()
+        brain.update_end_distances()
+        self.assertEqual(self._distances(), learned)
+
+    def testBatchLearnStale(self):
+        brain = self._brain
+        brain.update_end_distances()
+
+        brain.start_batch_learning()
+        brain.learn("this is a test")
+        self.assertFalse(brain.graph.has_end_distances())
+        brain.stop_batch_learning()
+
+        # a full batch leaves the distances for update_end_distances
+        self.assertFalse(brain.graph.has_end_distances())
+        self.assertEqual("stale", brain.graph.get_info_text("end_distances"))
+
+        brain.update_end_distances()
+        self.assertTrue(brain.graph.has_end_distances())
+        self.assertEqual(6, len([row for row in self._distances()
+                                 if row[1] is not None]))
+
+    def testStagedBatchRelaxes(self):
+        brain = self._brain
+        brain.learn("this is a long test of the distances")
+        brain.update_end_distances()
+
+        brain.start_batch_learning(size_hint=1)
+        self.assertTrue(brain._staged)
+
+        brain.learn("this is short")
+        brain.graph.commit()
+        brain.learn("a test of them")
+        brain.stop_batch_learning()
+
+        self.assertTrue(brain.graph.has_end_distances())
+        self.assertEqual(2, brain.graph.get_end_distance(
+            self._node("is", "short"), 1))
+
+        learned = self._distances()
+        brain.update_end_distances()
+        self.assertEqual(self._distances(), learned)
+
+    def testWalksSkipDeadEnds(self):
+        brain = self._brain
+        brain.learn("this is a test")
+
+        # an edge to a node that can't reach the end context
+        graph = brain.graph
+        dead = graph.get_node_by_tokens(
+            [graph.get_token_by_text("a"),
+             graph.get_token_by_text("banana", create=True)])
+        graph.add_edge(self._node("is", "a"), dead, True)
+        graph.add_edge(self._node("is", "a"), dead, True)
+        graph.commit()
+
+        end = brain._end_context_id
+        self.assertEqual([], list(graph.search_random_walk(dead, end, 1)))
+
+        brain.update_end_distances()
+        self.assertEqual(None, graph.get_end_distance(dead, 1))
+
+        start = self._node("this", "is")
+        for i in range(10):
+            self.assertEqual(1, len(list(graph.search_random_walk(
+                start, end, 1))))
+            self.assertEqual(1, len(list(brain._search_beam(start, end, 1))))
+
+        graph.enable_adjacency_cache(1000)
+        for i in range(10):
+            self.assertEqual(1, len(list(graph.search_random_walk(
+                start, end, 1))))
+
+    def testDrop(self):
+        brain = self._brain
+        brain.learn("this is a test")
+        brain.update_end_distances()
+        brain.drop_end_distances()
+
+        self.assertFalse(brain.graph.has_end_distances())
+        brain.learn("this is another test")
+        self.assertEqual("this is a test", brain.reply("a"))
+
+
+class testMerge(unittest.TestCase):
+    FILES = [TEST_BRAIN_FILE, "test_cobe_a.brain", "test_cobe_b.brain"]
+
+    def setUp(self):
+        for filename in self.FILES:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def tearDown(self):
+        for filename in self.FILES[1:]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _dump(self, brain):
+        # describe the graph in terms of token text, independent of ids
+        c = brain.graph.cursor()
+
+        nodes = {}
+        q = "SELECT nodes.id, nodes.count, %s FROM nodes" % \
+            ",".join(["(SELECT text FROM tokens WHERE id = %s)" % token
+                      for token in brain.graph._node_tokens])
+        for row in c.execute(q):
+            nodes[row[0]] = (tuple(row[2:]), row[1])
+
+        edges = set()
+        q = "SELECT prev_node, next_node, has_space, count FROM edges"
+        for prev, next, has_space, count in c.execute(q):
+            edges.add((nodes[prev][0], nodes[next][0], has_space, count))
+
+        return set(nodes.values()), edges
+
+    def _merge(self, packed):
+        # packed is whether each of self.FILES uses packed node keys
+        lines_a = ["this is a test", "this is another test"]
+        lines_b = ["this is a test", "something else entirely"]
+
+        for filename, lines in zip(self.FILES, [lines_a + lines_b,
+                                                lines_a, lines_b]):
+            Brain.init(filename, order=2)
+            brain = Brain(filename)
+            for line in lines:
+                brain.learn(line)
+
+        expected = self._dump(Brain(TEST_BRAIN_FILE))
+
+        os.remove(TEST_BRAIN_FILE)
+        Brain.init(TEST_BRAIN_FILE, order=2, packed_keys=packed[0])
+
+        for filename, packed_keys in zip(self.FILES[1:], packed[1:]):
+            if packed_keys:
+                Brain.upgrade(filename, packed_keys=True)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.merge(self.FILES[1])
+        brain.merge(self.FILES[2])
+
+        self.assertEqual(expected, self._dump(brain))
+
+    def testMerge(self):
+        self._merge([False, False, False])
+
+    def testMergePackedKeys(self):
+        self._merge([True, False, True])
+
+    def testMergeWrongOrder(self):
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        Brain.init(self.FILES[1], order=3)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        self.assertRaises(CobeError, brain.merge, self.FILES[1])
+
+
+class testCompile(unittest.TestCase):
+    COMPILED_FILE = "test_cobe_compiled.brain"
+
+    def setUp(self):
+        for filename in (TEST_BRAIN_FILE, self.COMPILED_FILE):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        self._brain = Brain(TEST_BRAIN_FILE)
+
+    def tearDown(self):
+        if os.path.exists(self.COMPILED_FILE):
+            os.remove(self.COMPILED_FILE)
+
+    def _edges(self, graph, edge_ids):
+        # describe each edge by its text, space and probability
+        return sorted(tuple(graph.get_text_by_edge(edge_id)) +
+                      (bool(graph.has_space(edge_id)),
+                       graph.get_edge_logprob(edge_id))
+                      for edge_id in edge_ids)
+
+    def testCompile(self):
+        brain = self._brain
+        brain.set_stemmer("english")
+
+        lines = ["this is a test", "this is another test",
+                 "testing is fun"]
+        for line in lines:
+            brain.learn(line)
+
+        brain.compile(self.COMPILED_FILE)
+        compiled = Brain(self.COMPILED_FILE)
+
+        self.assertEqual(brain.order, compiled.order)
+        self.assertEqual("english", compiled.graph.get_info_text("stemmer"))
+
+        c = brain.graph.cursor()
+        edge_ids = [row[0] for row in c.execute("SELECT id FROM edges")]
+        self.assertEqual(self._edges(brain.graph, edge_ids),
+                         self._edges(compiled.graph,
+                                     range(1, len(edge_ids) + 1)))
+
+        graph = compiled.graph
+        test_id = graph.get_token_by_text("test")
+        self.assertEqual("test", graph._token_string(test_id))
+        self.assertEqual(None, graph.get_token_by_text("missing"))
+        self.assertEqual(2, len(graph.get_token_stem_id("test")))
+        self.assertEqual([test_id], graph.get_word_tokens([test_id, None]))
+
+        for i in range(10):
+            self.assertTrue(compiled.reply("fun", loop_ms=10) in lines)
+
+        self.assertRaises(CobeError, compiled.learn, "this is a test")
+
+        compiled.graph.close()
+
+    def testCompileReadOnly(self):
+        self._brain.learn("this is a test")
+        self._brain.graph.close()
+
+        brain = Brain(TEST_BRAIN_FILE, readonly=True)
+        brain.compile(self.COMPILED_FILE)
+
+        # the read-only connection is read-only again
+        self.assertRaises(sqlite3.OperationalError,
+                          brain.graph.cursor().execute,
+                          "CREATE TEMP TABLE t (a)")
+
+        compiled = Brain(self.COMPILED_FILE)
+        self.assertEqual("this is a test",
+                         compiled.reply("test", loop_ms=10))
+        compiled.graph.close()
+
+
+class testFragmentCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+
+        brain = Brain(TEST_BRAIN_FILE)
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+        brain.graph.close()
+
+    def _fragments(self, brain):
+        return sum(len(entry[1].fragments) + len(entry[2].fragments)
+                   for entry in map(brain._fragment_cache.get,
+                                    brain._fragment_cache.keys()))
+
+    def testKeptBetweenReplies(self):
+        brain = Brain(TEST_BRAIN_FILE, fragment_cache_size=100)
+
+        brain.reply("test", loop_ms=10)
+        self.assertTrue(self._fragments(brain) > 0)
+
+        # learning drops the fragments of the nodes it touches
+        node = brain._fragment_cache.keys()[0]
+
+        brain.learn("this is a test")
+        self.assertFalse(node in brain._fragment_cache)
+
+    def testTtl(self):
+        brain = Brain(TEST_BRAIN_FILE, fragment_cache_size=100,
+                      fragment_cache_ttl=0)
+        brain.reply("test", loop_ms=10)
+
+        node = brain._fragment_cache.keys()[0]
+        time.sleep(0.01)
+
+        next_store, prev_store = brain._fragment_stores(node)
+        self.assertEqual([], next_store.fragments + prev_store.fragments)
+
+    def testRefill(self):
+        brain = Brain(TEST_BRAIN_FILE, fragment_cache_size=100)
+        self.assertEqual(0, brain.refill_fragment_cache(budget_ms=10))
+
+        brain.reply("test", loop_ms=10)
+        brain._forget_fragments()
+
+        self.assertTrue(brain.refill_fragment_cache(budget_ms=10) > 0)
+        self.assertTrue(self._fragments(brain) > 0)
+
+    def testDisabled(self):
+        brain = Brain(TEST_BRAIN_FILE)
+
+        brain.reply("test", loop_ms=10)
+        self.assertEqual(None, brain._fragment_cache)
+        self.assertEqual(0, brain.refill_fragment_cache(budget_ms=10))
+
+
+class testReplyCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        self._brain = Brain(TEST_BRAIN_FILE, reply_cache_size=10)
+
+        self._lines = ["this is a test", "this is another test",
+                       "this is fun"]
+        for line in self._lines:
+            self._brain.learn(line)
+
+    def testCached(self):
+        brain = self._brain
+        self.assertTrue(brain.reply("this", loop_ms=50) in self._lines)
+
+        # the pool holds the best few distinct replies
+        key = (frozenset([brain.graph.get_token_by_text("this")]), None, 50,
+               None, "random", "uniform")
+        stamp, learned, pool = brain._reply_cache.get(key)
+        texts = [text for text, reply in pool]
+        self.assertEqual(sorted(self._lines), sorted(texts))
+
+        # punctuation isn't a pivot, so this is the same prompt
+        for i in range(10):
+            brain.scorer.scorers[0][1].cache["stale"] = True
+
+            start = time.time()
+            self.assertTrue(brain.reply("this!", loop_ms=50) in texts)
+            self.assertTrue(time.time() - start < 0.04)
+
+            # hits end the reply with the scorer, as searches do
+            self.assertEqual({}, brain.scorer.scorers[0][1].cache)
+
+    def testKey(self):
+        brain = self._brain
+        brain.reply("this", loop_ms=10)
+
+        # a different budget or search is a different reply
+        brain.reply("this", loop_ms=20)
+        brain.reply("this", loop_ms=20, max_len=30)
+        brain.engine = "beam"
+        brain.reply("this", loop_ms=20, max_len=30)
+        self.assertEqual(4, len(brain._reply_cache))
+
+    def testLearnExpires(self):
+        brain = self._brain
+        brain.reply("this", loop_ms=10)
+
+        key = brain._reply_cache.keys()[0]
+
+        brain.REPLY_CACHE_LEARNED = 2
+        brain.learn("this is new")
+        self.assertTrue(brain._cached_reply(key)[0] in self._lines)
+
+        brain.learn("this is newer")
+        self.assertEqual(None, brain._cached_reply(key))
+        self.assertEqual(0, len(brain._reply_cache))
+
+    def testTtl(self):
+        brain = self._brain
+        brain._reply_cache_ttl = 0
+
+        brain.reply("this", loop_ms=10)
+        self.assertEqual(1, len(brain._reply_cache))
+
+        key = brain._reply_cache.keys()[0]
+        self.assertEqual(None, brain._cached_reply(key))
+        self.assertEqual(0, len(brain._reply_cache))
+
+    def testBabbleNotCached(self):
+        self._brain.reply("unknown", loop_ms=10)
+        self.assertEqual(0, len(self._brain._reply_cache))
+
 
 class testReply(unittest.TestCase):
     def setUp(self):
@@ -181,5 +1178,233 @@ class testReply(unittest.TestCase):
         brain.learn("this is a test")
         brain.reply("this is a test")
 
+    def testReplyTopk(self):
+        brain = self._brain
+
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+        brain.learn("this is fun")
+
+        replies = brain.reply_topk("this", 3, loop_ms=50)
+
+        self.assertTrue(1 <= len(replies) <= 3)
+
+        texts = [reply.text for reply in replies]
+        self.assertEqual(len(texts), len(set(texts)))
+
+        scores = [reply.score for reply in replies]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+        for reply in replies:
+            self.assertTrue(reply.text in ("this is a test",
+                                           "this is another test",
+                                           "this is fun"))
+
+    def testReplyMany(self):
+        brain = self._brain
+
+        brain.learn("this is a test")
+        brain.learn("this is fun")
+
+        replies = brain.reply_many(["this", "fun", "test"], loop_ms=10,
+                                   max_candidates=5)
+
+        self.assertEqual(3, len(list(replies)))
+
+        # the caches turned on for the batch are off again
+        self.assertEqual(None, brain.graph._stem_cache)
+        self.assertEqual(None, brain.graph._adjacency_cache)
+
+    def testReplyManyProcesses(self):
+        brain = self._brain
+
+        brain.learn("this is a test")
+
+        replies = list(brain.reply_many(["this", "test"], loop_ms=10,
+                                        processes=2))
+
+        self.assertEqual(["this is a test"] * 2, replies)
+
+    def testReplyRepeatedFragments(self):
+        # every walk finds the same fragments, so the search must stop
+        # on its deadline without seeing new candidates
+        brain = self._brain
+        brain.learn("this is a test")
+
+        start = time.time()
+        self.assertEqual("this is a test", brain.reply("test", loop_ms=10))
+        self.assertTrue(time.time() - start < 5)
+
+    def testFragmentStore(self):
+        store = _FragmentStore(8)
+
+        for i in range(100):
+            self.assertTrue(store.add(array.array("q", [i, i + 1])))
+
+        self.assertFalse(store.add(store.fragments[0]))
+
+        # the reservoir and the cross product are both bounded
+        self.assertEqual(8, len(store.fragments))
+        self.assertEqual(8, len(store.keys))
+        self.assertEqual(3, len(store.sample(3)))
+        self.assertEqual(8, len(store.sample(20)))
+
+    def testCandidatePairsCapped(self):
+        brain = self._brain
+        brain.REPLY_PAIRS_PER_FRAGMENT = 2
+
+        for word in ["red", "green", "blue", "black", "white"]:
+            brain.learn("%s is a test" % word)
+            brain.learn("this is %s" % word)
+
+        pivots = {brain.graph.get_token_by_text("is")}
+        deadline = time.time() + 0.2
+
+        # five prefixes and five suffixes can meet at "is", but with
+        # two pairs per new fragment at most 2 * 10 replies are built
+        replies = brain._generate_replies(pivots, deadline)
+        count = collections.Counter(node for prev, next, node in replies)
+
+        self.assertTrue(len(count) > 0)
+        for node, n in count.items():
+            self.assertTrue(n <= 20)
+
+    def testBeamEngine(self):
+        self._brain.graph.close()
+
+        brain = Brain(TEST_BRAIN_FILE, engine="beam")
+        lines = ["this is a test", "this is another test", "this is fun"]
+        for line in lines:
+            brain.learn(line)
+
+        for i in range(5):
+            self.assertTrue(brain.reply("this", loop_ms=10) in lines)
+
+        replies = brain.reply_topk("this", 3, loop_ms=50)
+        self.assertEqual(sorted(lines),
+                         sorted(reply.text for reply in replies))
+
+    def testBeamSearch(self):
+        brain = self._brain
+        brain.learn("this is a test")
+
+        node = brain.graph.get_random_node_with_token(
+            brain.graph.get_token_by_text("test"))
+
+        forward = list(brain._search_beam(node, brain._end_context_id, 1))
+        self.assertEqual(1, len(forward))
+
+        backward = list(brain._search_beam(node, brain._end_context_id, 0))
+        self.assertEqual(1, len(backward))
+
+    def testBeamLengthPrior(self):
+        brain = self._brain
+        brain.BEAM_WIDTH = 2
+        brain.BEAM_NOISE = 0
+
+        long_word = "pneumonoultramicroscopicsilicovolcanoconiosis"
+        for line in ["go to a x", "go to a y"] * 2 + \
+                ["go to %s x" % long_word, "go to %s y" % long_word]:
+            brain.learn(line)
+
+        graph = brain.graph
+        start = graph.get_node_by_tokens([graph.get_token_by_text("go"),
+                                          graph.get_token_by_text("to")])
+
+        # the paths through the long word are rarer, so they have more
+        # information, but less per character: the beam keeps the
+        # others once the four of them compete
+        paths = list(brain._search_beam(start, brain._end_context_id, 1))
+        texts = [Reply(graph, [], [], start, path).to_text()
+                 for path in paths]
+        self.assertEqual(["to a x", "to a y"], sorted(texts))
+
+    def testReplyMaxLen(self):
+        brain = self._brain
+
+        brain.learn("this is a test")
+        brain.learn("this is a much longer test with many more words")
+
+        for i in range(5):
+            self.assertEqual("this is a test",
+                             brain.reply("this", loop_ms=10, max_len=20))
+
+        # candidates over max_len are never built
+        pivots = {brain.graph.get_token_by_text("this")}
+        deadline = time.time() + 0.05
+        for prev, next, node in brain._generate_replies(pivots, deadline,
+                                                        20):
+            reply = Reply(brain.graph, [], [], node, prev + next)
+            self.assertTrue(len(reply.to_text()) <= 20)
+
+    def testEdgeLength(self):
+        brain = self._brain
+        brain.learn("this is a test, with punctuation")
+
+        token = brain.graph.get_token_by_text("test")
+        node = brain.graph.get_random_node_with_token(token)
+        end = brain._end_context_id
+
+        edges = next(brain.graph.search_bfs(node, end, 0))[::-1] + \
+            next(brain.graph.search_bfs(node, end, 1))
+
+        text = Reply(brain.graph, [], [], node, edges).to_text()
+        self.assertEqual(len(text), brain._fragment_length(edges))
+
+        # walks give up once they pass max_len
+        self.assertEqual([], list(brain.graph.search_random_walk(
+            node, end, 1, max_len=5)))
+        self.assertEqual([], list(brain._search_beam(node, end, 1, 5)))
+
+    def testResolvePivots(self):
+        brain = self._brain
+        brain.learn("this is a test")
+        brain.learn("this is another test")
+
+        graph = brain.graph
+        this = graph.get_token_by_text("this")
+        is_id = graph.get_token_by_text("is")
+        dead = graph.get_token_by_text("nowhere", create=True)
+
+        pivots, cum_weights = brain._resolve_pivots([this, (is_id, dead)])
+        self.assertEqual([(this, 1), (is_id, 2)], pivots)
+        self.assertEqual([1.0, 1.5], cum_weights)
+
+        brain.pivot_policy = "rarity"
+        pivots, cum_weights = brain._resolve_pivots([this, is_id])
+        self.assertEqual([1.0, 1.5], cum_weights)
+
+        brain.pivot_policy = "fanout"
+        pivots, cum_weights = brain._resolve_pivots([this, is_id])
+        self.assertEqual([1.0, 3.0], cum_weights)
+
+        # a reply around a dead pivot finds nothing, rather than
+        # searching from a missing node until the deadline
+        self.assertEqual([], list(brain._generate_replies(
+            {dead}, time.time() + 10)))
+
+    def testBabble(self):
+        brain = self._brain
+        self.assertEqual(set(), brain._babble())
+
+        brain.learn("this is a test.")
+        brain.graph.get_token_by_text("nowhere", create=True)
+
+        words = {brain.graph.get_token_by_text(word)
+                 for word in ["this", "is", "a", "test"]}
+        for i in range(10):
+            self.assertTrue(brain._babble() <= words)
+
+    def testUnknownPivotPolicy(self):
+        self.assertRaises(CobeError, Brain, TEST_BRAIN_FILE,
+                          pivot_policy="nope")
+
+    def testUnknownEngine(self):
+        self.assertRaises(CobeError, Brain, TEST_BRAIN_FILE, engine="nope")
+
+    def testReplyTopkEmpty(self):
+        self.assertEqual([], self._brain.reply_topk("this", 3, loop_ms=10))
+
+
 if __name__ == '__main__':
     unittest.main()
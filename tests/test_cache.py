@@ -0,0 +1,51 @@
+import unittest
+
+from cobe.cache import LRUCache
+
+class testLRUCache(unittest.TestCase):
+    def testGetPut(self):
+        cache = LRUCache(2)
+
+        self.assertEqual(None, cache.get("a"))
+
+        cache.put("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertTrue("a" in cache)
+
+    def testEviction(self):
+        cache = LRUCache(2)
+
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # touch "a" so "b" is the least recently used entry
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def testSizeof(self):
+        evicted = []
+        cache = LRUCache(4, sizeof=len,
+                         on_evict=lambda key, value: evicted.append(key))
+
+        cache.put("a", [1, 2])
+        cache.put("b", [1, 2])
+        self.assertEqual(4, cache.size)
+
+        cache.put("c", [1])
+        self.assertEqual(["a"], evicted)
+        self.assertEqual(3, cache.size)
+
+    def testPop(self):
+        cache = LRUCache(2)
+
+        cache.put("a", 1)
+        self.assertEqual(1, cache.pop("a"))
+        self.assertEqual(None, cache.pop("a"))
+        self.assertEqual(0, cache.size)
+
+if __name__ == '__main__':
+    unittest.main()
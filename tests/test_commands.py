@@ -1,6 +1,9 @@
+import argparse
+import os
 import unittest
 
-from cobe.commands import LearnIrcLogCommand
+from cobe.brain import Brain
+from cobe.commands import LearnIrcLogCommand, MergeCommand
 
 class testIrcLogParsing(unittest.TestCase):
     def setUp(self):
@@ -42,5 +45,41 @@ class testIrcLogParsing(unittest.TestCase):
 
         self.assertEqual(None, cmd._parse_irc_message(msg, ["foo"]))
 
+class testMergeCommand(unittest.TestCase):
+    FILES = ["test_cobe_merged.brain", "test_cobe_input.brain"]
+
+    def setUp(self):
+        self.tearDown()
+
+        Brain.init(self.FILES[1], order=2, packed_keys=True)
+        brain = Brain(self.FILES[1])
+        brain.set_stemmer("english")
+        brain.learn("this is a test")
+        brain.graph.close()
+
+    def tearDown(self):
+        for filename in self.FILES:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def testSettings(self):
+        MergeCommand.run(argparse.Namespace(brain=self.FILES[0],
+                                            file=self.FILES[1:]))
+
+        brain = Brain(self.FILES[0])
+        self.assertTrue(brain.graph.packed_keys)
+        self.assertEqual("english", brain.graph.get_info_text("stemmer"))
+        self.assertEqual("this is a test", brain.reply("test"))
+
+    def testSameBrain(self):
+        # merging a brain into itself, or twice, is refused
+        for brain, files in [(self.FILES[1], self.FILES[1:]),
+                             (self.FILES[0],
+                              [self.FILES[1], "./" + self.FILES[1]])]:
+            with self.assertLogs("cobe", "ERROR"):
+                MergeCommand.run(argparse.Namespace(brain=brain, file=files))
+
+            self.assertFalse(os.path.exists(self.FILES[0]))
+
 if __name__ == '__main__':
     unittest.main()
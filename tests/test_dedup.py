@@ -0,0 +1,65 @@
+import unittest
+
+from cobe.dedup import BloomFilter, Deduplicator, normalize
+
+class testBloomFilter(unittest.TestCase):
+    def testAdd(self):
+        bloom = BloomFilter(100)
+
+        self.assertFalse(b"a" in bloom)
+        self.assertFalse(bloom.add(b"a"))
+        self.assertTrue(b"a" in bloom)
+        self.assertTrue(bloom.add(b"a"))
+        self.assertEqual(1, bloom.count)
+
+        bloom.clear()
+        self.assertFalse(b"a" in bloom)
+        self.assertEqual(0, bloom.count)
+
+    def testErrorRate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(str(i).encode("ascii"))
+
+        false = sum(1 for i in range(1000, 11000)
+                    if str(i).encode("ascii") in bloom)
+        self.assertTrue(false < 300)
+
+class testDeduplicator(unittest.TestCase):
+    def testNormalize(self):
+        self.assertEqual("this is a test", normalize("  This  is\ta TEST "))
+
+    def testSkip(self):
+        dedup = Deduplicator()
+
+        lines = ["this is a test", "This is a  test", "another test",
+                 "this is a test"]
+        self.assertEqual([True, False, True, False],
+                         [dedup.allow(line) for line in lines])
+        self.assertEqual(4, dedup.seen)
+        self.assertEqual(2, dedup.dropped)
+
+    def testSkipFull(self):
+        # a full filter is emptied rather than grown
+        dedup = Deduplicator(capacity=2)
+
+        self.assertTrue(dedup.allow("a"))
+        self.assertTrue(dedup.allow("b"))
+        self.assertTrue(dedup.allow("a"))
+
+    def testCap(self):
+        dedup = Deduplicator(max_repeats=2, window=4)
+
+        # the fourth "a" starts a new window
+        lines = ["a", "a", "a", "b", "a", "a", "a"]
+        self.assertEqual([True, True, False, True, True, True, False],
+                         [dedup.allow(line) for line in lines])
+        self.assertEqual(2, dedup.dropped)
+
+    def testArguments(self):
+        self.assertRaises(ValueError, Deduplicator, max_repeats=0)
+        self.assertRaises(ValueError, Deduplicator, max_repeats=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
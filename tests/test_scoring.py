@@ -0,0 +1,83 @@
+import glob
+import os
+import time
+import unittest
+
+from cobe.brain import Brain, Reply
+from cobe import scoring
+
+TEST_BRAIN_FILE = "test_cobe_scoring.brain"
+
+
+def tearDownModule():
+    for filename in glob.glob(TEST_BRAIN_FILE + "*"):
+        os.remove(filename)
+
+class testFragmentScores(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_BRAIN_FILE):
+            os.remove(TEST_BRAIN_FILE)
+
+        Brain.init(TEST_BRAIN_FILE, order=2)
+        self._brain = Brain(TEST_BRAIN_FILE)
+
+        for line in ["this is a test", "this is another test",
+                     "this is fun, isn't it?", "is this a test?",
+                     "a test is a test is a test"]:
+            self._brain.learn(line)
+
+    def _fragments(self):
+        brain = self._brain
+        pivots = {brain.graph.get_token_by_text("is"),
+                  brain.graph.get_token_by_text("test")}
+
+        return list(brain._generate_replies(pivots, time.time() + 0.05))
+
+    def _check(self, scorer):
+        graph = self._brain.graph
+
+        for prev, next, node in self._fragments():
+            reply = Reply(graph, [], [], node, prev + next)
+
+            combined = scorer.combine(graph, scorer.fragment(graph, prev),
+                                      scorer.fragment(graph, next))
+            self.assertEqual(scorer.score(reply), combined)
+
+    def testCobeScorer(self):
+        self._check(scoring.CobeScorer())
+
+    def testInformationScorer(self):
+        self._check(scoring.InformationScorer())
+
+    def testLengthScorer(self):
+        self._check(scoring.LengthScorer())
+
+    def testScorerGroup(self):
+        group = scoring.ScorerGroup()
+        group.add_scorer(1.0, scoring.CobeScorer())
+        group.add_scorer(-0.5, scoring.LengthScorer())
+
+        self._check(group)
+
+    def testInformation(self):
+        # the information is summed edge by edge, in reply order
+        graph = self._brain.graph
+        scorer = scoring.InformationScorer()
+
+        for prev, next, node in self._fragments():
+            reply = Reply(graph, [], [], node, prev + next)
+
+            info = 0.
+            for edge_id in reply.edge_ids:
+                info -= graph.get_edge_logprob(edge_id)
+
+            self.assertEqual(scorer.normalize(info), scorer.score(reply))
+
+    def testCombineDefault(self):
+        scorer = scoring.Scorer()
+        self.assertEqual(None, scorer.fragment(self._brain.graph, []))
+        self.assertEqual(None, scorer.combine(self._brain.graph, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()